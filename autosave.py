@@ -0,0 +1,125 @@
+"""
+Background project autosave.
+"""
+
+import Queue
+import threading
+import time
+
+import projectfile
+from util import set_thread_name, log
+
+# Seconds between saves while the project keeps changing
+AUTOSAVE_INTERVAL = 10
+
+
+class AutoSaveThread(threading.Thread):
+    """
+    Saves the project in the background.
+
+    snapshot() is called from the editing loops and is cheap: at most once
+    per interval it takes snapshots of the patterns whose change counters
+    moved since the last one and hands them over. The thread packs them,
+    reuses the packed data of the unchanged patterns and writes the file
+    through a temporary file and a rename.
+    """
+    def __init__(self, filename, interval=AUTOSAVE_INTERVAL):
+        super(AutoSaveThread, self).__init__()
+        set_thread_name("beatkit autosave")
+        self.daemon = True
+        self.filename = filename
+        self.interval = interval
+        self.saves = 0
+        self.last_error = None
+        self._queue = Queue.Queue()
+        self._last_snapshot = time.time()
+        # Editing thread side: project info and pattern changes() last sent
+        self._info = None
+        self._changes = {}
+        self._order = None
+        # Saving thread side: pattern -> (packed pattern, its data blocks)
+        self._packed = {}
+
+    def snapshot(self, project, force=False):
+        """
+        Queue a save of whatever changed in project, if the interval passed
+        or force is set
+        """
+        now = time.time()
+        if not force and now - self._last_snapshot < self.interval:
+            return
+        self._last_snapshot = now
+
+        info = {
+            'name': project.name,
+            'bpm': project.bpm,
+            'tempo': project.tempo_map.dump(),
+            'patterns_seq': list(project.patterns_seq),
+        }
+        patterns = []
+        changes = {}
+        dirty = False
+        for pattern in project.patterns:
+            key = pattern.changes()
+            changes[pattern] = key
+            if self._changes.get(pattern) == key:
+                patterns.append((pattern, pattern.uid, None))
+            else:
+                patterns.append((pattern, pattern.uid, pattern.snapshot()))
+                dirty = True
+
+        order = [pattern for pattern, uid, data in patterns]
+        if not dirty and info == self._info and order == self._order:
+            return
+        self._info = info
+        self._changes = changes
+        self._order = order
+        self._queue.put((info, patterns))
+
+    def run(self):
+        running = True
+        while running:
+            snapshots = [self._queue.get()]
+            while True:
+                try:
+                    snapshots.append(self._queue.get_nowait())
+                except Queue.Empty:
+                    break
+            if None in snapshots:
+                running = False
+                snapshots.remove(None)
+
+            # Every snapshot brings its changed patterns, but only the latest
+            # one needs to be written
+            for info, patterns in snapshots:
+                for pattern, uid, data in patterns:
+                    if data is not None:
+                        blocks = {}
+                        packed = projectfile.pack_pattern(data, blocks)
+                        self._packed[pattern] = (packed, blocks)
+            if snapshots:
+                self._save(*snapshots[-1])
+
+    def _save(self, info, patterns):
+        self._packed = dict((p, self._packed[p]) for p, uid, d in patterns)
+        blocks = {}
+        for packed, pattern_blocks in self._packed.values():
+            blocks.update(pattern_blocks)
+        try:
+            projectfile.write_file(self.filename, projectfile.join(
+                info, [(uid, self._packed[p][0]) for p, uid, d in patterns],
+                blocks
+            ))
+            self.saves += 1
+        except (IOError, OSError) as e:
+            self.last_error = e
+            log('Autosave failed: {}'.format(e))
+
+    def quit(self, project=None):
+        """
+        Save the last changes of project and stop once they are written
+        """
+        if project is not None:
+            self.snapshot(project, force=True)
+        self._queue.put(None)
+        self.join()
@@ -1,18 +1,18 @@
+import argparse
 import os
 import time
-from copy import deepcopy
 import traceback
 
 import sdlcurses
 import keys
 import events
 import project
-from connections import seq, connect
-
-try:
-    import ujson as json
-except ImportError:
-    import json
+import midifile
+import projectfile
+import connections
+from connections import connect
+from undo import UndoJournal
+from autosave import AutoSaveThread
 
 from track import (
     TRACK_TYPE_DRUM,
@@ -32,9 +32,15 @@ from player import (
 )
 
 
+# Session state, saved in the background and opened on start
+STATE_NAME = 'state'
+
 EMPTY_NOTE = ' '
 MIDI_MIDDLE = 60
 
+# Pattern editor frames per second
+FRAME_RATE = 30
+
 
 class TrackEditor(object):
     def __init__(self, scr, track):
@@ -54,7 +60,7 @@ class TrackEditor(object):
                 if k:
                     track.name = v
             elif self.pos == 1:
-                options = seq.ports.keys()
+                options = connections.seq.ports.keys()
                 k, v = scr.listbox(1, 15, 30, track.midi_port, options=options,
                                    edit=True)
                 if k:
@@ -112,7 +118,7 @@ class TrackEditor(object):
 
 
 class PatternEditor(object):
-    def __init__(self, project, pattern, pad, player):
+    def __init__(self, project, pattern, pad, player, autosave=None):
         self._current_track = 0
         self._track_offset = 0
         self._octave = 0
@@ -120,21 +126,26 @@ class PatternEditor(object):
         self.pattern = pattern
         self.pad = pad
         self.player = player
+        self.autosave = autosave
         self.rec = True
         self.delete_keys = ['A', 'S', 'D', 'F']
-        self._undo_buffer = [self.pattern.dump()]
+        # The journal does not see loading lazy tracks as a change, so load
+        # them before it takes the state edits are undone to
+        self.pattern.materialize()
+        self._undo = UndoJournal(self.pattern)
         self._prev_pos = None
+        # What paint() left on the screen: the header, the key of every
+        # track row and track -> (version, pattern length, cells, row text)
+        self._erase_count = None
+        self._painted_header = None
+        self._painted = []
+        self._rows = {}
 
     def push_undo(self):
-        current_state = self.pattern.dump()
-        if current_state != self._undo_buffer[-1]:
-            self._undo_buffer.append(current_state)
+        self._undo.commit()
 
     def pop_undo(self):
-        if len(self._undo_buffer) > 1:
-            self._undo_buffer.pop()
-        self.pattern.load(self._undo_buffer[-1])
-        self._undo_buffer = deepcopy(self._undo_buffer)
+        self._undo.undo()
 
     def run(self):
         delete_keys = self.delete_keys
@@ -161,33 +172,43 @@ class PatternEditor(object):
         pad = self.pad
         pad.erase()
 
-        prev_time = None
-        repaint = 0
         pad.find_font_size(self.pattern.len*3+20, len(self.pattern.tracks))
+        # Frames are drawn on a fixed schedule, handling an event only marks
+        # the view as dirty. Clean frames just move the playhead.
+        frame = 1. / FRAME_RATE
+        next_frame = time.time()
+        dirty = True
         while True:
+            if self.autosave:
+                self.autosave.snapshot(self.project)
+            self.player.update_data()
+            now = time.time()
+            if now >= next_frame:
+                self._octave = key_to_midi_octave
+                self.paint(only_pos=not dirty)
+                dirty = False
+                next_frame += frame
+                if next_frame < now:
+                    # Too far behind to catch up, start over from now
+                    next_frame = now + frame
             try:
-                ev = events.get()
+                ev = events.get(timeout=max(0., next_frame - time.time()))
             except Exception:
-                curr_time = int(self.player.get_time())
-                if prev_time != curr_time:
-                    prev_time = curr_time
-                    self.paint(only_pos=True)
-
                 continue
 
+            dirty = True
             if ev.event_type == events.EVENT_QUIT:
                 events.put(ev)
                 break
 
             if ev.event_type == events.EVENT_REFRESH:
-                self.paint()
+                pad.touchwin()
                 continue
 
             if ev.event_type == events.EVENT_RESIZE:
                 pad.resize(ev.width, ev.height)
                 pad.find_font_size(self.pattern.len*3+20,
                                    len(self.pattern.tracks))
-                self.paint()
                 continue
 
             self._current_track = min(self._current_track,
@@ -221,8 +242,8 @@ class PatternEditor(object):
                     if not midi_state:
                         self.push_undo()
             elif ev.event_type == events.EVENT_MIDI_CONTROLLER:
-                seq.set_control(track._midi_port, ev.value, ev.param,
-                                ev.channel)
+                connections.seq.set_control(track._midi_port, ev.value,
+                                            ev.param, ev.channel)
             elif ev.event_type == events.EVENT_MIDI_PITCHBEND:
                 ntime = self.player.get_time()
                 if self.rec:
@@ -267,8 +288,7 @@ class PatternEditor(object):
                                 MIDI_EVENT_PITCH
                             )
                     elif command == 'd':
-                        tmp_track = track.__class__()
-                        tmp_track.load(track.dump())
+                        tmp_track = track.copy()
                         self.pattern.tracks.append(tmp_track)
                         self._current_track = len(self.pattern.tracks) - 1
                     elif command == 'r':
@@ -281,7 +301,7 @@ class PatternEditor(object):
                     elif command == 'en':
                         track.name = parameters
                     elif command == 'bpm':
-                        set_bpm(parameters, self.project)
+                        set_bpm(parameters, self.project, self.player)
                     elif command == 'pl':
                         self.pattern.resize(int(parameters))
 
@@ -367,21 +387,16 @@ class PatternEditor(object):
                                                         midi_note, 127))
                         key_to_midi_state[midi_note] = False
 
-            nowtime = time.time()
-            if repaint < nowtime - 0.05:
-                self._octave = key_to_midi_octave
-                self.paint()
-                repaint = nowtime
-
     def paint(self, only_pos=False):
         pad = self.pad
-        tracks = self.pattern.tracks
-        current_track = self._current_track
-        curr_time = self.player.get_time()
-        y = 0
-        pad.addstr(
-            y,
-            0,
+        if self._erase_count != pad.erase_count:
+            # The screen was wiped, nothing we drew is left
+            self._erase_count = pad.erase_count
+            self._painted_header = None
+            self._painted = []
+            self._prev_pos = None
+
+        header = (
             'Pattern Name: {} | Len: {} | Octave: {} | BPM: {} | {}         '
             .format(
                 self.pattern.name,
@@ -391,68 +406,108 @@ class PatternEditor(object):
                 '(REC)' if self.rec else '(---)'
             )
         )
+        if header != self._painted_header:
+            pad.addstr(0, 0, header)
+            self._painted_header = header
+
         y = 1
         if self.pattern.tracks:
-            if self._prev_pos:
-                pad.addstr(y, self._prev_pos, " ", keys.A_BOLD)
-
-            pos = (21 + int(curr_time) % self.pattern.len*3)
-            pad.addstr(y, pos, "*", keys.A_BOLD)
-            self._prev_pos = pos
-
-        y = 2
+            # One transport reading per frame
+            transport = self.player.transport()
+            pos = (21 + int(transport.time) % self.pattern.len*3)
+            if pos != self._prev_pos:
+                if self._prev_pos:
+                    pad.addstr(y, self._prev_pos, " ", keys.A_BOLD)
+                pad.addstr(y, pos, "*", keys.A_BOLD)
+                self._prev_pos = pos
+
+        if not only_pos:
+            self._paint_tracks(2)
 
-        for track in tracks:
-            if only_pos:
-                break
-            i = tracks.index(track)
-            offset_len = len(self.delete_keys)
+        pad.refresh(0, 0, 0, 0, 30, 100)
 
-            attr = keys.A_BOLD if i == current_track else 0
+    def _paint_tracks(self, y):
+        """
+        Draw the track rows from screen row y, skipping the rows that show
+        the same track, version and selection as last time
+        """
+        pad = self.pad
+        tracks = self.pattern.tracks
+        pattern_len = self.pattern.len
+        offset_len = len(self.delete_keys)
+        start = (self._track_offset * offset_len) % pattern_len
+        end = start + offset_len
+        painted = self._painted
+        rows = {}
+
+        for i, track in enumerate(tracks):
+            row = self._rows.get(track)
+            if row is None or row[:2] != (track.version, pattern_len):
+                data = ['-'] * pattern_len
+                if track.track_type == TRACK_TYPE_DRUM:
+                    data = track.data
+                elif track.track_type == TRACK_TYPE_BASSLINE:
+                    data = track.beat_data
+                row = (track.version, pattern_len, list(data),
+                       "[" + "][".join(data) + "]")
+            rows[track] = row
+
+            selected = i == self._current_track
+            key = (track, track.name, row[0], pattern_len,
+                   selected and (start, end))
+            if i < len(painted) and painted[i] == key:
+                continue
 
+            attr = keys.A_BOLD if selected else 0
             pad.addstr(y+i, 0, "{: >20}".format(track.name), attr)
-
-            data = ['-'] * self.pattern.len
-            if track.track_type == TRACK_TYPE_DRUM:
-                data = track.data
-            elif track.track_type == TRACK_TYPE_BASSLINE:
-                data = track.beat_data
-
-            pad.addstr(y+i, 20, "[" + "][".join(data) + "]")
-
-            if attr:
-                start = (self._track_offset * offset_len) % self.pattern.len
-                end = start + offset_len
+            pad.addstr(y+i, 20, row[3])
+            if selected:
                 pad.addstr(y+i, 3*start + 20, "[" + "]["
-                           .join(data[start:end]) + "]", attr)
+                           .join(row[2][start:end]) + "]", attr)
 
-        pad.refresh(0, 0, 0, 0, 30, 100)
+            if i < len(painted):
+                painted[i] = key
+            else:
+                painted.append(key)
+
+        # Rows of tracks removed since the last paint
+        for i in xrange(len(tracks), len(painted)):
+            pad.clrtoeol(y+i)
+        del painted[len(tracks):]
+        self._rows = rows
 
 
 class ProjectEditor(object):
-    def __init__(self, project, scr, player):
+    def __init__(self, project, scr, player, autosave=None):
         self.project = project
         self.scr = scr
         self.player = player
+        self.autosave = autosave
         self._pattern = None
         self._seq_pos = 0
         self._seq_edit = False
         self._debug = ''
-        self._undo_buffer = [self.project.dump()]
+        self._undo = UndoJournal(self.project)
 
     def push_undo(self):
-        self._undo_buffer.append(self.project.dump())
+        """
+        Record everything changed since the last call as one undo step
+        """
+        if self._undo.root is not self.project:
+            self._undo = UndoJournal(self.project)
+        self._undo.commit()
 
     def pop_undo(self):
-        if len(self._undo_buffer) > 1:
-            self._undo_buffer.pop()
-        self.project.load(self._undo_buffer[-1])
+        self._undo.undo()
 
     def run(self):
         row_keys = {keys.KEY_UP: -1, keys.KEY_DOWN: 1}
         move_pattern_keys = {keys.KEY_SR: -1, keys.KEY_SF: 1}
         self.refresh()
         while True:
+            if self.autosave:
+                self.autosave.snapshot(self.project)
+            self.player.update_data()
             try:
                 ev = events.get()
             except Exception:
@@ -461,6 +516,11 @@ class ProjectEditor(object):
             if ev.event_type == events.EVENT_QUIT:
                 break
 
+            if ev.event_type == events.EVENT_REFRESH:
+                self.scr.touchwin()
+                self.refresh()
+                continue
+
             if ev.event_type != events.EVENT_KEY_DOWN:
                 continue
 
@@ -470,12 +530,15 @@ class ProjectEditor(object):
                     ('n', ['_New Project']),
                     ('o', ['_Open Project']),
                     ('s', ['_Save Project']),
+                    ('em', ['_Export _Midi File']),
                     ('np', ['_New', '_Pattern']),
                     ('dp', ['_Duplicate', '_Pattern']),
                     ('ep', ['_Edit', '_Pattern']),
                     ('epn', ['_Edit', '_Pattern', '_Name']),
                     ('rp', ['_Remove', '_Pattern']),
                     ('bpm', ['_Beats _per _minute']),
+                    ('tc', ['_Tempo _Change']),
+                    ('stats', ['Playback _Stats']),
                     ('q', ['_Quit']),
                 ]).run()
 
@@ -485,11 +548,15 @@ class ProjectEditor(object):
                     self.player.stop()
                     self.project = project.create_empty_project()
                 elif command == 'o':
-                    with open('{}.json'.format(parameters), 'r') as f:
-                        self.project.load(json.loads(f.read()))
+                    self.project.load(projectfile.open_project(
+                        project_filename(parameters)))
                 elif command == 's':
-                    with open('{}.json'.format(parameters), 'w') as f:
-                        f.write(json.dumps(self.project.dump(), indent=2))
+                    projectfile.save(self.project.snapshot(),
+                                     '{}.bkp'.format(parameters))
+                elif command == 'em':
+                    self.project.rebuild_sequence()
+                    midifile.export_project(self.project,
+                                            '{}.mid'.format(parameters))
                 elif command == 'np':
                     self._new_pattern(parameters)
                 elif command == 'dp':
@@ -503,6 +570,10 @@ class ProjectEditor(object):
                     self._remove_pattern()
                 elif command == 'bpm':
                     self._set_bpm(parameters)
+                elif command == 'tc':
+                    self._tempo_change(parameters)
+                elif command == 'stats':
+                    self._show_stats(parameters)
             elif c == 'q' or k == keys.KEY_ESC:
                 break
             elif k in row_keys:
@@ -576,7 +647,7 @@ class ProjectEditor(object):
                 self.project.rebuild_sequence()
                 if self.player.playing():
                     self.player.stop()
-                self.player.play(self.project)
+                self.player.play(self.project, self.project.tempo_map)
             else:
                 self._debug = 'DEBUG: KEY {} | CHAR "{}"'.format(k, c)
 
@@ -584,12 +655,8 @@ class ProjectEditor(object):
             self.refresh()
 
     def refresh(self):
-        addstr = self.scr.addstr
-        self.scr.erase()
-        addstr(0, 0, 'PROJECT: {: <20} | BPM {}'.format(self.project.name,
-                                                        self.project.bpm))
-        addstr(2, 0, '[{: ^40}] [{: ^40}]'.format('PATTERNS', 'SEQUENCE'))
-        y = 3
+        scr = self.scr
+        patterns = []
         for pattern in self.project.patterns:
             if self._pattern not in self.project.patterns:
                 self._pattern = pattern
@@ -600,9 +667,11 @@ class ProjectEditor(object):
                 a, b, attr = '.', '.', 0
             attr = 0 if self._seq_edit else attr
 
-            addstr(y, 0, '[{}{:.^38}{}]'.format(a, pattern.name, b), attr)
-            y = y + 1
-        addstr(y + 1, 0, self._debug)
+            patterns.append(('[{}{:.^38}{}]'.format(a, pattern.name, b), attr))
+        patterns += [('', 0), (self._debug, 0)]
+
+        names = dict((p.uid, p.name) for p in self.project.patterns)
+        sequence = []
         for y, pattern_uid in enumerate(self.project.patterns_seq):
             if self._seq_pos is None:
                 self._seq_pos = len(self.project.patterns_seq)-1
@@ -613,11 +682,32 @@ class ProjectEditor(object):
                 a, b, attr = '.', '.', 0
             attr = attr if self._seq_edit else 0
 
-            name = [p.name for p in self.project.patterns
-                    if p.uid == pattern_uid]
-            addstr(y+3, 43, '[{}{:.^38}{}]'.format(a, name[0], b), attr)
+            sequence.append(('[{}{:.^38}{}]'.format(a, names[pattern_uid], b),
+                             attr))
 
-        self.scr.refresh(0, 0, 0, 0, 30, 100)
+        # Write over the previous contents instead of erasing the screen, so
+        # only the cells that changed are drawn again
+        lines = [
+            'PROJECT: {: <20} | BPM {}'.format(self.project.name,
+                                               self.project.bpm),
+            '',
+            '[{: ^40}] [{: ^40}]'.format('PATTERNS', 'SEQUENCE'),
+        ]
+        for y, line in enumerate(lines):
+            scr.addstr(y, 0, line)
+            scr.clrtoeol(y, len(line))
+
+        y = len(lines)
+        for i in xrange(max(len(patterns), len(sequence))):
+            text, attr = patterns[i] if i < len(patterns) else ('', 0)
+            scr.addstr(y + i, 0, text, attr)
+            scr.addstr(y + i, len(text), ' ' * (43 - len(text)))
+            text, attr = sequence[i] if i < len(sequence) else ('', 0)
+            scr.addstr(y + i, 43, text, attr)
+            scr.clrtoeol(y + i, 43 + len(text))
+        scr.clrtobot(y + max(len(patterns), len(sequence)))
+
+        scr.refresh(0, 0, 0, 0, 30, 100)
 
     def _new_pattern(self, name):
         self.push_undo()
@@ -635,9 +725,7 @@ class ProjectEditor(object):
             return
 
         self.push_undo()
-        new_pattern = project.Pattern()
-        new_pattern.load(self._pattern.dump())
-        new_pattern.uid = project.gen_uid()
+        new_pattern = self._pattern.copy()
         i = 1
         tmp_name = '{} ({})'.format(new_pattern.name, i)
         while len([n for n in self.project.patterns if n.name == tmp_name]):
@@ -650,12 +738,20 @@ class ProjectEditor(object):
         if self._pattern is None:
             return
 
+        # Loaded before the step is recorded, see PatternEditor
+        self._pattern.materialize()
+        self.push_undo()
         PatternEditor(
             self.project,
             self._pattern,
             self.scr,
             self.player,
+            self.autosave,
         ).run()
+        # The whole editing session is a single step here
+        self.push_undo()
+        # Pick up the pattern changes in the compiled song
+        self.project.rebuild_sequence()
 
     def _remove_pattern(self):
         if self._pattern is None:
@@ -672,54 +768,147 @@ class ProjectEditor(object):
 
     def _set_bpm(self, bpm):
         self.push_undo()
-        set_bpm(bpm, self.project)
+        set_bpm(bpm, self.project, self.player)
+
+    def _tempo_change(self, parameters):
+        # "beat bpm" for a tempo change, "beat bpm end_beat end_bpm" for a ramp
+        values = (parameters or '').split()
+        if len(values) not in [2, 4] or not all(
+                v.replace('.', '', 1).isdigit() for v in values):
+            return
+        values = [float(v) for v in values]
+        if not all(bpm > 0 for bpm in values[1::2]):
+            return
+        if len(values) == 4 and values[2] < values[0]:
+            # A ramp can't end before it starts
+            return
+
+        self.push_undo()
+        if len(values) == 2:
+            self.project.tempo_map.set_tempo(*values)
+        else:
+            self.project.tempo_map.set_ramp(*values)
+        if self.player.playing() and self.player.data is self.project:
+            self.player.set_tempo_map(self.project.tempo_map)
+
+    def _show_stats(self, parameters):
+        if parameters == 'clear':
+            self.player.clear_stats()
+
+        scr = self.scr
+        scr.erase()
+        stats = self.player.get_stats()
+        for y, name in enumerate(sorted(stats)):
+            values = ' | '.join(
+                '{} {}'.format(key, _format_stat(value))
+                for key, value in sorted(stats[name].items())
+            )
+            scr.addstr(y, 0, '{: <16} {}'.format(name, values))
+        scr.addstr(len(stats) + 1, 0, 'Times in ms. Press any key.')
+        scr.refresh()
+
+        while True:
+            try:
+                ev = events.get()
+            except Exception:
+                continue
+            if ev.event_type in [events.EVENT_KEY_DOWN, events.EVENT_QUIT]:
+                break
 
     def _pattern_idx(self):
         return self.project.patterns.index(self._pattern)
 
 
-def set_bpm(bpm, project):
-    if bpm and str(bpm).isdigit():
-        bpm = int(bpm)
+def _format_stat(value):
+    if isinstance(value, float):
+        return '{:.2f}'.format(value)
+    return value
+
+
+def project_filename(name):
+    """
+    Return the binary project file for name, or the JSON one when there is
+    only a project saved by an older version
+    """
+    filename = '{}.bkp'.format(name)
+    if not os.path.exists(filename) and os.path.exists(name + '.json'):
+        return name + '.json'
+    return filename
+
+
+def set_bpm(bpm, project, player=None):
+    # Text from the command line or a number from the project file
+    try:
+        bpm = float(bpm)
+    except (TypeError, ValueError):
+        return
+    if 0 < bpm < float('inf'):
+        if bpm.is_integer():
+            bpm = int(bpm)
         project.bpm = bpm
         BPM.set(bpm)
+        if player:
+            player.set_bpm(bpm)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='BeatKit')
+    parser.add_argument(
+        '--lookahead', type=int, default=0, metavar='MS',
+        help='post events this many milliseconds ahead to the sequencer '
+             'queue (default: send them when they are due)')
+    parser.add_argument(
+        '--jack-process', action='store_true',
+        help='play from the JACK process callback, one window per period')
+    return parser.parse_args()
 
 
 def main():
-    connect()
+    args = parse_args()
+    try:
+        connect()
+    except RuntimeError as e:
+        print 'Cannot start: {}'.format(e)
+        return
 
     proj = project.create_empty_project()
 
-    if os.path.exists('state.json'):
-        with open('state.json') as f:
-            proj.load(json.loads(f.read()))
+    state_file = project_filename(STATE_NAME)
+    if os.path.exists(state_file):
+        proj.load(projectfile.open_project(state_file))
 
     screen = sdlcurses.initscr('BeatKit v0.1', 'beatkit.png')
 
     # Pattern Player thread
-    player = PlayerThread()
+    player = PlayerThread(lookahead=max(args.lookahead, 0),
+                          jack_process=args.jack_process)
     player.start()
-    set_bpm(proj.bpm, project)
+    set_bpm(proj.bpm, proj, player)
 
     # Input sources
     keychars = sdlcurses.PyGameThread()
     keychars.start()
-    midi_input = events.MidiInThread(seq)
+    midi_input = events.MidiInThread(connections.seq)
     midi_input.start()
 
-    app = ProjectEditor(proj, screen, player)
+    autosave = AutoSaveThread('{}.bkp'.format(STATE_NAME))
+    autosave.start()
+
+    app = ProjectEditor(proj, screen, player, autosave)
 
     try:
         app.run()
     except Exception:
         print traceback.format_exc()
 
-    with open('state.json', 'w') as f:
-        f.write(json.dumps(app.project.dump(), indent=2))
+    autosave.quit(app.project)
 
     player.quit()
     keychars.stop()
     midi_input.stop()
+    # Stop polling the sequencer input before closing it
+    midi_input.join()
+    connections.seq.close()
 
 
 if __name__ == "__main__":
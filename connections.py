@@ -1,38 +1,56 @@
-from sequencer_interface import SequencerInterface
 from sequencer_interface import (
-    SEQ_PORT_CAP_WRITE,
-    SEQ_PORT_CAP_SUBS_WRITE,
+    alsaseq,
+    SequencerInterface,
 )
 
 
-seq = SequencerInterface('beatkit')
+def open_sequencer(name):
+    """
+    Open the ALSA sequencer. Tests and benchmarks without a sound stack
+    install a MemorySequencer with set_sequencer() instead.
+    """
+    if alsaseq is None:
+        raise RuntimeError('pyalsa is not installed, there is no MIDI output')
+    return SequencerInterface(name)
 
 
-def get_ports():
-    # Get MIDI Input ports LIST
-    ports = {}
-    required_cap = SEQ_PORT_CAP_WRITE | SEQ_PORT_CAP_SUBS_WRITE
+# Opened by the first connect(), unless set_sequencer() chose a backend
+seq = None
+
+
+def set_sequencer(backend):
+    """
+    Replace the output backend used by tracks and the player
+    """
+    global seq
+    seq = backend
+    return seq
 
-    for client_name, client_id, client_ports in seq.seq.connection_list():
-        for port_name, port_id, properties in client_ports:
-            capability = seq.seq.get_port_info(
-                port_id, client_id).get('capability', 0)
-            if capability & required_cap == required_cap:
-                if port_name.startswith(client_name):
-                    name = port_name
-                else:
-                    name = "{} - {}".format(client_name, port_name)
-                ports[name] = (client_id, port_id)
 
-    return ports
+def get_port(name):
+    """
+    Return the id of our output port called name, None when there is no
+    such port or no sequencer open
+    """
+    if seq is None:
+        return None
+    return seq.ports.get(name)
+
+
+def get_ports():
+    # Get MIDI Input ports LIST
+    return seq.output_ports()
 
 
 def connect():
+    global seq
+    if seq is None:
+        seq = open_sequencer('beatkit')
     oports = get_ports()
 
     for port_name, data in oports.iteritems():
         dest_id, dest_port = data
-        if dest_id == seq.seq.client_id:
+        if dest_id == seq.client_id:
             continue
         if port_name not in seq.ports:
             source_port = seq.create_output(port_name)
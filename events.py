@@ -1,5 +1,8 @@
 import Queue
+import select
 import threading
+from collections import deque
+from time import time
 from util import set_thread_name
 
 from sequencer_interface import (
@@ -9,6 +12,10 @@ from sequencer_interface import (
     MIDI_EVENT_NOTE_OFF,
 )
 
+# Milliseconds the input thread waits for MIDI before checking if it should
+# stop
+INPUT_POLL_TIMEOUT = 250
+
 EVENT_NONE = 0
 EVENT_KEY_UP = 1
 EVENT_KEY_DOWN = 2
@@ -20,22 +27,105 @@ EVENT_REFRESH = 128
 EVENT_RESIZE = 256
 
 
-event_queue = Queue.Queue()
+class CoalescingQueue(object):
+    """
+    FIFO event queue where, in coalescing mode, an event with a
+    coalesce_key() replaces the value of the event with the same key when
+    that one is the last event queued, instead of being added. Controller
+    floods then take one slot per (type, channel, param) and never jump
+    ahead of the key presses or notes queued after them.
+    """
+    def __init__(self, coalesce=True):
+        self.coalesce = coalesce
+        self.coalesced = 0
+        self._items = deque()
+        # key -> one element list holding the latest event for that key
+        self._pending = {}
+        self._cond = threading.Condition(threading.Lock())
+
+    def qsize(self):
+        return len(self._items)
+
+    def put(self, ev):
+        with self._cond:
+            self._put(ev)
+            self._cond.notify()
+
+    def put_many(self, evs):
+        """
+        Queue several events taking the lock only once
+        """
+        with self._cond:
+            for ev in evs:
+                self._put(ev)
+            self._cond.notify()
+
+    def _put(self, ev):
+        # Called with the lock held
+        key = ev.coalesce_key() if self.coalesce else None
+        if key is None:
+            self._items.append((None, ev))
+            return
+        box = self._pending.get(key)
+        if box is not None and self._items[-1][1] is box:
+            box[0] = ev
+            self.coalesced += 1
+            return
+        # Anything queued since the pending event must stay ahead of this
+        # one, queue it again
+        box = self._pending[key] = [ev]
+        self._items.append((key, box))
+
+    def get(self, timeout=None):
+        with self._cond:
+            if timeout is not None:
+                end = time() + timeout
+            while not self._items:
+                if timeout is None:
+                    self._cond.wait()
+                    continue
+                remaining = end - time()
+                if remaining <= 0:
+                    raise Queue.Empty()
+                self._cond.wait(remaining)
+
+            key, item = self._items.popleft()
+            if key is None:
+                return item
+            if self._pending.get(key) is item:
+                del self._pending[key]
+            return item[0]
+
 
+event_queue = CoalescingQueue()
 
-def get():
-    return event_queue.get(timeout=0.3)
+
+def get(timeout=0.3):
+    return event_queue.get(timeout=timeout)
 
 
 def put(ev):
     event_queue.put(ev)
 
 
+def put_many(evs):
+    event_queue.put_many(evs)
+
+
 class Event(object):
+    __slots__ = ()
     event_type = EVENT_NONE
 
+    def coalesce_key(self):
+        """
+        Events with the same key are merged while queued, the last one wins.
+        None means the event is always queued.
+        """
+        return None
+
 
 class KeyboardDownEvent(Event):
+    __slots__ = ('key_code', 'char')
     event_type = EVENT_KEY_DOWN
 
     def __init__(self, key_code, char=None):
@@ -45,6 +135,7 @@ class KeyboardDownEvent(Event):
 
 
 class KeyboardUpEvent(Event):
+    __slots__ = ('key_code', 'char')
     event_type = EVENT_KEY_UP
 
     def __init__(self, key_code, char=None):
@@ -54,6 +145,7 @@ class KeyboardUpEvent(Event):
 
 
 class MidiNoteEvent(Event):
+    __slots__ = ('midi_event_type', 'channel', 'note', 'velocity')
     event_type = EVENT_MIDI_NOTE
 
     def __init__(self, midi_event_type, channel, note, velocity):
@@ -64,6 +156,7 @@ class MidiNoteEvent(Event):
 
 
 class MidiControllerEvent(Event):
+    __slots__ = ('midi_event_type', 'channel', 'param', 'value')
     event_type = EVENT_MIDI_CONTROLLER
 
     def __init__(self, channel, param, value):
@@ -72,8 +165,12 @@ class MidiControllerEvent(Event):
         self.param = param
         self.value = value
 
+    def coalesce_key(self):
+        return (EVENT_MIDI_CONTROLLER, self.channel, self.param)
+
 
 class MidiPitchbendEvent(Event):
+    __slots__ = ('midi_event_type', 'channel', 'value')
     event_type = EVENT_MIDI_PITCHBEND
 
     def __init__(self, channel, value):
@@ -81,16 +178,22 @@ class MidiPitchbendEvent(Event):
         self.channel = channel
         self.value = value
 
+    def coalesce_key(self):
+        return (EVENT_MIDI_PITCHBEND, self.channel)
+
 
 class QuitEvent(Event):
+    __slots__ = ()
     event_type = EVENT_QUIT
 
 
 class RefreshEvent(Event):
+    __slots__ = ()
     event_type = EVENT_REFRESH
 
 
 class ResizeEvent(Event):
+    __slots__ = ('width', 'height')
     event_type = EVENT_RESIZE
 
     def __init__(self, width, height):
@@ -98,6 +201,53 @@ class ResizeEvent(Event):
         self.height = height
 
 
+def _note_on(data):
+    # Deal with Keystation 61es "Note off"
+    event_type = MIDI_EVENT_NOTE_ON
+    if not data['note.velocity']:
+        event_type = MIDI_EVENT_NOTE_OFF
+    return MidiNoteEvent(event_type, data['note.channel'], data['note.note'],
+                         data['note.velocity'])
+
+
+def _note_off(data):
+    return MidiNoteEvent(MIDI_EVENT_NOTE_OFF, data['note.channel'],
+                         data['note.note'], data['note.velocity'])
+
+
+def _controller(data):
+    return MidiControllerEvent(data['control.channel'],
+                               data['control.param'],
+                               data['control.value'])
+
+
+def _pitchbend(data):
+    return MidiPitchbendEvent(data['control.channel'], data['control.value'])
+
+
+# Sequencer event type -> function building our event from the event data.
+# Anything else (clock, sysex...) is ignored.
+MIDI_INPUT_EVENTS = {
+    MIDI_EVENT_NOTE_ON: _note_on,
+    MIDI_EVENT_NOTE_OFF: _note_off,
+    MIDI_EVENT_CONTROLLER: _controller,
+    MIDI_EVENT_PITCH: _pitchbend,
+}
+
+
+def convert_input(seq_events):
+    """
+    Return our events for a batch of sequencer events
+    """
+    converters = MIDI_INPUT_EVENTS
+    events = []
+    for ev in seq_events:
+        convert = converters.get(ev.type)
+        if convert is not None:
+            events.append(convert(ev.get_data()))
+    return events
+
+
 class MidiInThread(threading.Thread):
     def __init__(self, seq):
         super(MidiInThread, self).__init__()
@@ -107,42 +257,74 @@ class MidiInThread(threading.Thread):
         self._run.set()
 
     def run(self):
+        poller = select.poll()
+        self.seq.register_input(poller)
         while self._run.is_set():
-            for ev in self.seq.event_input():
-                data = ev.get_data()
-
-                if ev.type == MIDI_EVENT_NOTE_ON:
-                    # Deal with Keystation 61es "Note off"
-                    if not data['note.velocity']:
-                        ev.type = MIDI_EVENT_NOTE_OFF
-                    event = MidiNoteEvent(
-                        ev.type,
-                        data['note.channel'],
-                        data['note.note'],
-                        data['note.velocity']
-                    )
-                elif ev.type == MIDI_EVENT_NOTE_OFF:
-                    event = MidiNoteEvent(
-                        ev.type,
-                        data['note.channel'],
-                        data['note.note'],
-                        data['note.velocity']
-                    )
-                elif ev.type == MIDI_EVENT_CONTROLLER:
-                    event = MidiControllerEvent(
-                        data['control.channel'],
-                        data['control.param'],
-                        data['control.value']
-                    )
-                elif ev.type == MIDI_EVENT_PITCH:
-                    event = MidiPitchbendEvent(
-                        data['control.channel'],
-                        data['control.value']
-                    )
-                else:
-                    continue
+            if not poller.poll(INPUT_POLL_TIMEOUT):
+                continue
 
-                put(event)
+            events = convert_input(self.seq.input_events())
+            if events:
+                put_many(events)
 
     def stop(self):
         self._run.clear()
+
+
+def benchmark(count=100000):
+    """
+    Measure the input path throughput: feed count events (MIDI clock,
+    controllers and notes) through a MemorySequencer and time how long it
+    takes until they can be read from the event queue.
+    """
+    from sequencer_interface import MemorySequencer, InputEvent
+
+    clock = InputEvent(36, {})
+    seq_events = []
+    for i in xrange(count / 4):
+        seq_events.append(clock)
+        seq_events.append(InputEvent(MIDI_EVENT_CONTROLLER, {
+            'control.channel': 0,
+            'control.param': i % 8,
+            'control.value': i % 128,
+        }))
+        seq_events.append(InputEvent(MIDI_EVENT_NOTE_ON, {
+            'note.channel': 0,
+            'note.note': 60,
+            'note.velocity': 100,
+        }))
+        seq_events.append(InputEvent(MIDI_EVENT_NOTE_OFF, {
+            'note.channel': 0,
+            'note.note': 60,
+            'note.velocity': 0,
+        }))
+
+    seq = MemorySequencer('benchmark')
+    thread = MidiInThread(seq)
+    thread.start()
+    read = 0
+    started = time()
+    for i in xrange(0, len(seq_events), 64):
+        seq.feed_input(seq_events[i:i + 64])
+        while event_queue.qsize():
+            get()
+            read += 1
+    while True:
+        try:
+            get()
+            read += 1
+        except Queue.Empty:
+            break
+    # The last get() waited for the timeout with the queue empty
+    elapsed = time() - started - 0.3
+    thread.stop()
+    thread.join()
+    seq.close()
+
+    print "{} input events, {} queued events read, {} coalesced".format(
+        len(seq_events), read, event_queue.coalesced)
+    print "{:.0f} input events per second".format(len(seq_events) / elapsed)
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,197 @@
+"""
+Standard MIDI File export.
+
+Renders a Project straight to a .mid file without the JACK transport or the
+sequencer, as fast as the events can be generated.
+"""
+
+import struct
+import sys
+from heapq import heappush, heappop
+
+from project import EVENT_STOP
+from track import TRACK_TYPE_DRUM
+
+from sequencer_interface import (
+    MIDI_EVENT_NOTE_ON as NOTE_ON,
+    MIDI_EVENT_NOTE_OFF as NOTE_OFF,
+    MIDI_EVENT_PITCH as PITCH,
+)
+
+# Ticks per quarter note
+PPQ = 96
+# Drum tracks only send note on, give the hits a 1/32 note length
+DRUM_NOTE_LEN = PPQ / 8
+
+META_TRACK_NAME = 0x03
+META_END_OF_TRACK = 0x2f
+META_TEMPO = 0x51
+
+
+def beat_to_tick(time, ppq=PPQ):
+    # Beatkit beats are eighth notes
+    return int(round(time * ppq / 2.))
+
+
+class MidiFileWriter(object):
+    """
+    Streaming writer for format 1 Standard MIDI Files.
+
+    Tracks are written to the file one after the other as their events come
+    in; the chunk lengths and the track count are patched in afterwards, so
+    the file object must be seekable.
+    """
+    def __init__(self, f, ppq=PPQ):
+        self.f = f
+        self.ppq = ppq
+        self.tracks = 0
+        self._chunk_pos = None
+        self._chunk_len = 0
+        self._tick = 0
+        f.write(b'MThd' + struct.pack('>LHHH', 6, 1, 0, ppq))
+
+    def start_track(self, name=None):
+        if self._chunk_pos is not None:
+            self.end_track()
+        self._chunk_pos = self.f.tell()
+        self._chunk_len = 0
+        self._tick = 0
+        self.f.write(b'MTrk' + struct.pack('>L', 0))
+        self.tracks += 1
+        if name:
+            self.meta(0, META_TRACK_NAME, name.encode('utf-8'))
+
+    def end_track(self):
+        self.meta(self._tick, META_END_OF_TRACK, b'')
+        end_pos = self.f.tell()
+        self.f.seek(self._chunk_pos + 4)
+        self.f.write(struct.pack('>L', self._chunk_len))
+        self.f.seek(end_pos)
+        self._chunk_pos = None
+
+    def close(self):
+        if self._chunk_pos is not None:
+            self.end_track()
+        end_pos = self.f.tell()
+        self.f.seek(10)
+        self.f.write(struct.pack('>H', self.tracks))
+        self.f.seek(end_pos)
+
+    def write(self, tick, data):
+        """
+        Write raw event data at an absolute tick. Ticks must not go back in
+        time within a track.
+        """
+        delta = max(0, tick - self._tick)
+        self._tick += delta
+        data = _varlen(delta) + data
+        self.f.write(data)
+        self._chunk_len += len(data)
+
+    def meta(self, tick, meta_type, data):
+        self.write(tick, struct.pack('>BB', 0xff, meta_type) +
+                   _varlen(len(data)) + data)
+
+    def tempo(self, tick, bpm):
+        # Microseconds per quarter note
+        usecs = int(round(60000000. / bpm))
+        self.meta(tick, META_TEMPO, struct.pack('>L', usecs)[1:])
+
+    def note_on(self, tick, channel, note, velocity):
+        self.write(tick, struct.pack('>BBB', 0x90 | (channel & 0x0f),
+                                     note & 0x7f, velocity & 0x7f))
+
+    def note_off(self, tick, channel, note):
+        self.write(tick, struct.pack('>BBB', 0x80 | (channel & 0x0f),
+                                     note & 0x7f, 0))
+
+    def pitchbend(self, tick, channel, value):
+        value = min(max(value + 8192, 0), 16383)
+        self.write(tick, struct.pack('>BBB', 0xe0 | (channel & 0x0f),
+                                     value & 0x7f, value >> 7))
+
+
+def _varlen(value):
+    data = [value & 0x7f]
+    value >>= 7
+    while value:
+        data.append(0x80 | (value & 0x7f))
+        value >>= 7
+    return struct.pack('>{}B'.format(len(data)), *reversed(data))
+
+
+def export_project(project, filename, ppq=PPQ):
+    """
+    Render the project song to a Standard MIDI File.
+
+    There is a tempo track followed by one track per midi port. The song
+    events are generated pattern by pattern while writing, so the whole song
+    is never held in memory.
+    """
+    ports = []
+    for pattern_start, pattern_end, pattern in project._play_seq:
+        for track in pattern.tracks:
+            if track.midi_port not in ports:
+                ports.append(track.midi_port)
+
+    with open(filename, 'wb') as f:
+        writer = MidiFileWriter(f, ppq)
+        writer.start_track(project.name)
+        for beat, bpm in project.tempo_map.segments:
+            writer.tempo(beat_to_tick(beat, ppq), bpm)
+        for port in ports:
+            writer.start_track(port)
+            _write_port_events(writer, project, port)
+        writer.close()
+
+
+def _write_port_events(writer, project, port):
+    ppq = writer.ppq
+    # Sounding notes per track, to be released when the song leaves it
+    active = {}
+    # (tick, channel, note) note offs for drum hits
+    pending = []
+    song_end = project._play_seq[-1][1] if project._play_seq else 0
+
+    for time, track, event, channel, note, velocity in project.iter_events():
+        if track.midi_port != port:
+            continue
+
+        tick = beat_to_tick(time, ppq)
+        while pending and pending[0][0] <= tick:
+            writer.note_off(*heappop(pending))
+
+        if event == EVENT_STOP:
+            for channel, note in active.pop(track, ()):
+                writer.note_off(tick, channel, note)
+        elif event == NOTE_ON:
+            writer.note_on(tick, channel, note, velocity)
+            if track.track_type == TRACK_TYPE_DRUM:
+                heappush(pending, (tick + DRUM_NOTE_LEN, channel, note))
+            else:
+                active.setdefault(track, set()).add((channel, note))
+        elif event == NOTE_OFF:
+            writer.note_off(tick, channel, note)
+            active.get(track, set()).discard((channel, note))
+        elif event == PITCH:
+            writer.pitchbend(tick, channel, velocity)
+
+    while pending:
+        writer.note_off(*heappop(pending))
+    tick = max(beat_to_tick(song_end, ppq), writer._tick)
+    for notes in active.values():
+        for channel, note in notes:
+            writer.note_off(tick, channel, note)
+
+
+if __name__ == "__main__":
+    import projectfile
+    from project import Project
+
+    if len(sys.argv) != 3:
+        print "Usage: {} project.bkp output.mid".format(sys.argv[0])
+        sys.exit(1)
+
+    proj = Project()
+    proj.load(projectfile.load(sys.argv[1], events=True))
+    export_project(proj, sys.argv[2])
@@ -1,12 +1,28 @@
+import struct
 import threading
 import jack
-from time import sleep
+from collections import namedtuple
+from time import sleep, time
 
 import connections
-from util import set_thread_name
+from tempo import TempoMap
+from util import set_thread_name, Histogram
 
 jack_client = jack.Client("beatkit")
 
+# Events handed from the JACK process callback to the player thread:
+# (frame, port, event_type, channel, param, value)
+CYCLE_EVENT = struct.Struct('<IiBHii')
+CYCLE_RING_SIZE = 1 << 16
+# Seconds between a cycle and the delivery of its events. The player thread
+# has this long to pick them up, so event timing stays locked to the cycle.
+CYCLE_LATENCY = 0.02
+CYCLE_POLL = 0.005
+# Seconds the transport may move forward between two play windows, on top
+# of the lookahead, before it counts as located elsewhere rather than the
+# player running late
+RELOCATE_SECONDS = 0.5
+
 
 class ObjectInt(object):
     value = None
@@ -23,15 +39,46 @@ class ObjectInt(object):
 
 BPM = ObjectInt(120)
 
+# Song time in beats and transport state, read together
+Transport = namedtuple('Transport', ['time', 'playing'])
+
 
 class PlayerThread(threading.Thread):
-    def __init__(self):
+    def __init__(self, lookahead=0, jack_process=False):
         set_thread_name("beatkit player")
         super(PlayerThread, self).__init__()
         self.data = None
         self._run = threading.Event()
         self._run.set()
         self.prev_time = 0
+        # Milliseconds of events posted ahead of time to the sequencer queue.
+        # With 0 every event is sent right away when the transport reaches it.
+        self.lookahead = lookahead
+        # Beat/frame conversion for what is playing. Live tempo changes swap
+        # in a new map, so it is never changed while another thread reads it.
+        self.tempo = TempoMap(BPM.get(), jack_client.samplerate)
+        # With jack_process the play windows come from the JACK process
+        # callback, one per period, and reach this thread through _ring.
+        self._ring = None
+        self._cycle_frame = 0
+        self._frames_per_beat = 0
+        self.overruns = 0
+        self._window_start = 0
+        self._seconds_per_beat = 0
+        # Milliseconds histograms, see get_stats()
+        self.stats = {
+            # Transport time at send minus the event time, down to
+            # -lookahead for the events posted ahead
+            'event_lateness': Histogram(-lookahead - 50, 50),
+            # Time overslept by the playing loop
+            'wakeup_lateness': Histogram(0, 50),
+            # Time spent in each play_range call
+            'play_range': Histogram(0, 20),
+        }
+        if jack_process:
+            self._ring = jack.RingBuffer(CYCLE_RING_SIZE)
+            jack_client.set_process_callback(self.process)
+            jack_client.activate()
 
     def run(self):
         self.prev_time = self.get_time()
@@ -41,6 +88,7 @@ class PlayerThread(threading.Thread):
 
             if not self.playing() or self.data is None:
                 if mute_notes:
+                    self.discard_cycle_events()
                     self.mute()
                     mute_notes = False
                 sleep(0.05)
@@ -49,16 +97,192 @@ class PlayerThread(threading.Thread):
 
             mute_notes = True
 
-            self.data.play_range(self.prev_time, curr_time)
+            if self._ring is not None:
+                self.send_cycle_events()
+                self._sleep(CYCLE_POLL)
+                continue
+
+            if self.lookahead:
+                self.schedule_range(curr_time)
+                self._sleep(self.lookahead / 2000.)
+                continue
+
+            if (curr_time < self.prev_time or
+                    self._jumped(self.prev_time, curr_time)):
+                # Transport located elsewhere, go on from there
+                self.mute()
+                self.prev_time = curr_time
+
+            self.play_window(self.prev_time, curr_time)
             self.prev_time = curr_time
-            sleep(0.01)
+            self._sleep(0.01)
 
-    def play(self, data):
-        self.set_data(data)
+    def _jumped(self, prev_time, curr_time):
+        """
+        True when the transport is further past prev_time than the player
+        could have fallen behind
+        """
+        seconds = RELOCATE_SECONDS + self.lookahead / 1000.
+        return curr_time - prev_time > seconds * self.tempo.bpm_at(
+            prev_time) / 30.
+
+    def _sleep(self, seconds):
+        started = time()
+        sleep(seconds)
+        self.stats['wakeup_lateness'].add((time() - started - seconds) * 1000)
+
+    def play_window(self, prev_time, curr_time):
+        """
+        Play the data from prev_time to curr_time, recording how long it
+        takes and how late each event is sent
+        """
+        seq = connections.seq
+        self._window_start = prev_time
+        self._seconds_per_beat = 30. / self.tempo.bpm_at(prev_time)
+        seq.monitor = self._monitor_event
+        started = time()
+        try:
+            with seq.batch():
+                self.data.play_range(prev_time, curr_time)
+        finally:
+            seq.monitor = None
+        self.stats['play_range'].add((time() - started) * 1000)
+
+    def _monitor_event(self, offset):
+        # Negative with lookahead: events are sent before they are due
+        lateness = self.get_time() - self._window_start - offset
+        self.stats['event_lateness'].add(
+            lateness * self._seconds_per_beat * 1000
+        )
+
+    def get_stats(self):
+        """
+        Return the summary of every playback histogram plus the sequencer
+        output counters
+        """
+        stats = dict((name, histogram.summary())
+                     for name, histogram in self.stats.items())
+        stats['output'] = connections.seq.flush_stats()
+        stats['output']['overruns'] = self.overruns
+        return stats
+
+    def clear_stats(self):
+        for histogram in self.stats.values():
+            histogram.clear()
+
+    def schedule_range(self, curr_time):
+        """
+        Post the events from the last scheduled time up to lookahead
+        milliseconds past curr_time to the sequencer queue. prev_time holds
+        how far the song has been scheduled so far.
+        """
+        seq = connections.seq
+        seconds_per_beat = 30. / self.tempo.bpm_at(curr_time)
+        end_time = curr_time + self.lookahead / 1000. / seconds_per_beat
+
+        if (self.prev_time > end_time or
+                self._jumped(self.prev_time, curr_time)):
+            # Transport located elsewhere, forget what was scheduled ahead
+            # and release the notes playing
+            self.mute()
+            self.prev_time = curr_time
+
+        if self.prev_time >= end_time:
+            return
+
+        seq.schedule(self.prev_time - curr_time, seconds_per_beat)
+        try:
+            self.play_window(self.prev_time, end_time)
+        finally:
+            seq.unschedule()
+        self.prev_time = end_time
+
+    def process(self, frames):
+        """
+        JACK process callback: play the beat window covered by this period.
+
+        Events are not sent from here; they go to the ring buffer tagged with
+        their frame, for send_cycle_events() to schedule.
+        """
+        data = self.data
+        state, position = jack_client.transport_query()
+        if state != jack.ROLLING or data is None:
+            return
+
+        frame = position['frame']
+        tempo = self.tempo
+        prev_time = tempo.frame_to_beat(frame)
+        self._cycle_frame = jack_client.last_frame_time
+        self._frames_per_beat = tempo.frames_per_beat(tempo.bpm_at(prev_time))
+        seq = connections.seq
+        seq.capture(self._capture_event)
+        started = time()
+        try:
+            data.play_range(prev_time, tempo.frame_to_beat(frame + frames))
+        finally:
+            seq.release()
+        self.stats['play_range'].add((time() - started) * 1000)
+
+    def _capture_event(self, port, event_type, channel, param, value, offset):
+        frame = self._cycle_frame + int(offset * self._frames_per_beat)
+        if self._ring.write_space < CYCLE_EVENT.size:
+            self.overruns += 1
+            return
+        self._ring.write(CYCLE_EVENT.pack(
+            frame & 0xffffffff, port, event_type, channel, param or 0, value
+        ))
+
+    def send_cycle_events(self):
+        """
+        Schedule the events queued by the process callback, CYCLE_LATENCY
+        seconds after the frame they belong to
+        """
+        ring = self._ring
+        size = CYCLE_EVENT.size
+        seq = connections.seq
+        now = jack_client.frame_time
+        samplerate = float(jack_client.samplerate)
+        with seq.batch():
+            while ring.read_space >= size:
+                frame, port, event_type, channel, param, value = (
+                    CYCLE_EVENT.unpack(ring.read(size))
+                )
+                # Frame times are 32 bit and wrap around
+                frames = (frame - now) & 0xffffffff
+                if frames & 0x80000000:
+                    frames -= 1 << 32
+                self.stats['event_lateness'].add(-frames / samplerate * 1000)
+                delay = max(0., frames / samplerate + CYCLE_LATENCY)
+                seq.send_delayed(port, event_type, channel, param, value,
+                                 delay)
+
+    def discard_cycle_events(self):
+        if self._ring is not None:
+            self._ring.read_advance(self._ring.read_space)
+
+    def play(self, data, tempo_map=None):
+        """
+        Start playing data (a Pattern or a Project) with the tempo changes in
+        tempo_map, or at the current BPM
+        """
+        if tempo_map is None:
+            tempo_map = TempoMap(BPM.get())
+        self.tempo = tempo_map.copy(jack_client.samplerate)
+        # Load and bind the tracks here, before the player thread sees them
         connections.connect()
-        self.data.bind()
+        data.bind()
+        data.compile()
+        self.set_data(data)
         jack_client.transport_start()
 
+    def update_data(self):
+        """
+        Compile the changes to what is playing. Called from the UI loops, so
+        the player thread never compiles.
+        """
+        if self.data is not None:
+            self.data.compile()
+
     def set_data(self, data):
         if data:
             self.mute()
@@ -75,18 +299,50 @@ class PlayerThread(threading.Thread):
 
     def quit(self):
         self._run.clear()
+        if self.is_alive():
+            self.join()
+        if self._ring is not None:
+            jack_client.deactivate()
         self.mute()
+        # Deletes the queue used for the lookahead
+        connections.seq.stop_queue()
 
     def playing(self):
         return jack_client.transport_state == jack.ROLLING
 
     def mute(self):
+        if self.lookahead or self._ring is not None:
+            connections.seq.drop_output()
         if self.data:
-            self.data.mute()
+            with connections.seq.batch():
+                self.data.mute()
+
+    def set_bpm(self, bpm):
+        """
+        Play at bpm from the current position on, without moving it
+        """
+        tempo = self.tempo.copy()
+        tempo.change_tempo(self.get_time(), bpm)
+        self.tempo = tempo
+
+    def set_tempo_map(self, tempo_map):
+        """
+        Play with the tempo changes of tempo_map from now on
+        """
+        self.tempo = tempo_map.copy(jack_client.samplerate)
+
+    def frame_to_time(self, frame):
+        return self.tempo.frame_to_beat(frame)
 
     def get_time(self):
         # Get the time on the song.
-        return (
-            float(jack_client.transport_frame) /
-            jack_client.samplerate * (BPM.get()/60.) * 2
-        )
+        return self.frame_to_time(jack_client.transport_frame)
+
+    def transport(self):
+        """
+        Return a Transport with the position and state of a single transport
+        query, so they always match
+        """
+        state, position = jack_client.transport_query()
+        return Transport(self.frame_to_time(position['frame']),
+                         state == jack.ROLLING)
@@ -1,91 +1,216 @@
-from copy import deepcopy
-from util import gen_uid
+from array import array
+from bisect import bisect_left, bisect_right
+from heapq import merge
+from util import gen_uid, next_version, Snapshot, thaw
+from tempo import TempoMap
 
 from track import (
     TRACK_TYPE_DRUM,
     DrumTrack,
     MidiTrack,
+    play_event,
 )
 
+# Timeline entry to silence a track when the song moves to another pattern
+EVENT_STOP = -1
+
 
 class Pattern(object):
+    # (changes(), snapshot) of the last snapshot taken
+    _snapshot = None
+
     def __init__(self, name=None, tracks=None, pattern_len=None, uid=None):
         self.name = name
         self.tracks = tracks
         self.len = pattern_len
         self.uid = gen_uid() if uid is None else uid
 
+    @property
+    def tracks(self):
+        self.materialize()
+        return self._tracks
+
+    @tracks.setter
+    def tracks(self, tracks):
+        self._source = None
+        self._tracks = tracks
+        self.touch()
+
+    def touch(self):
+        """
+        Mark the pattern as changed
+        """
+        self.version = next_version()
+
+    def changes(self):
+        """
+        Return a value that differs whenever the pattern or one of its tracks
+        changed since the last call, without loading lazy tracks
+        """
+        if self._source is not None:
+            return (self.version, self.name, self.len, self.uid)
+        return (self.version, self.name, self.len, self.uid,
+                tuple((t.version, t.header()) for t in self._tracks or ()))
+
+    def loaded(self):
+        """
+        False while the tracks are still waiting in the project file
+        """
+        return self._source is None
+
+    def load_lazy(self, source):
+        """
+        Build the tracks from source(events) the first time they are used.
+        source returns the dumped pattern, with the MidiTrack events as an
+        EventStore when events is True.
+        """
+        self._tracks = None
+        self._source = source
+        self.touch()
+
+    def materialize(self):
+        """
+        Build the tracks now if they are still waiting in the project file
+        """
+        if self._source is None:
+            return
+        source, self._source = self._source, None
+        self._tracks = [load_track(track) for track in source(True)['tracks']]
+        self.touch()
+
     def resize(self, lenght):
         for track in self.tracks:
             track.stop()
             track.resize(lenght)
         self.len = lenght
+        self.touch()
 
     def bind(self):
+        # Called on the UI thread before playing, so lazy tracks are built
+        # here rather than by the player thread
         for track in self.tracks:
             track.bind()
 
-    def play_range(self, prev_time, curr_time):
+    def compile(self):
+        """
+        Compile the tracks changed since they last played. Called on the UI
+        thread, the player only reads the compiled sequences.
+        """
         for track in self.tracks:
-            track.play_range(prev_time, curr_time)
+            track.compile()
 
-    def mute(self):
+    def play_range(self, prev_time, curr_time, offset=0):
         for track in self.tracks:
+            track.play_range(prev_time, curr_time, offset)
+
+    def mute(self):
+        for track in self._tracks or ():
             track.stop()
 
+    def iter_events(self, start=0, end=None):
+        """
+        Yield (time, track, event, channel, note, velocity) for every event
+        played from start to end, looping the tracks to fill the pattern
+        length
+        """
+        if end is None:
+            end = start + self.len
+        tracks = self.tracks
+        loops = [_iter_track_loop(track, i, start, end)
+                 for i, track in enumerate(tracks)]
+        for time, i, event, channel, note, velocity in merge(*loops):
+            yield time, tracks[i], event, channel, note, velocity
+
+    def copy(self):
+        """
+        Return a new pattern, with its own uid, whose tracks share the
+        events with this one until they are edited
+        """
+        return Pattern(self.name, [track.copy() for track in self.tracks],
+                       self.len)
+
+    def snapshot(self):
+        """
+        Return the data of dump() as a read only Snapshot, reusing the
+        snapshots of the unchanged tracks. Lazy patterns are read from the
+        project file without building their tracks.
+        """
+        key = self.changes()
+        if self._snapshot is None or self._snapshot[0] != key:
+            if self._source is not None:
+                tracks = [_freeze(track)
+                          for track in self._source(True)['tracks']]
+            else:
+                tracks = [track.snapshot() for track in self._tracks]
+            self._snapshot = (key, Snapshot({
+                'uid': self.uid,
+                'name': self.name,
+                'len': self.len,
+                'tracks': tuple(tracks),
+            }))
+        return self._snapshot[1]
+
     def dump(self):
-        return deepcopy({
-            'uid': self.uid,
-            'name': self.name,
-            'len': self.len,
-            'tracks': [c.dump() for c in self.tracks],
-        })
+        return thaw(self.snapshot())
 
     def load(self, data):
         self.uid = data.get('uid', gen_uid())
         self.name = data['name']
         self.len = data['len']
-        self.tracks = []
-        for track in data['tracks']:
-            if track['track_type'] == TRACK_TYPE_DRUM:
-                tmp_track = DrumTrack(
-                    track['name'],
-                    track['data'],
-                    track.get('midi_port', 'Undefined'),
-                    track.get('midi_channel', 0),
-                    track['note'],
-                )
-            else:
-                tmp_track = MidiTrack()
-                tmp_track.load(track)
-            self.tracks.append(tmp_track)
+        self.tracks = [load_track(track) for track in data['tracks']]
 
 
 class Project(object):
+    # (play sequence, pattern start beats, compiled patterns), see compile()
+    _timeline = None
+    # pattern -> (changes(), times, entries, tracks) for one loop of it
+    _compiled = {}
+
     def __init__(self, name=None, patterns=None, patterns_seq=None, bpm=120):
         self.name = name or 'Untitled'
         self.patterns = patterns or []
         self.patterns_seq = patterns_seq or []
-        self.bpm = bpm
+        self.tempo_map = TempoMap(bpm)
         self.rebuild_sequence()
 
-    def dump(self):
-        return deepcopy({
+    @property
+    def bpm(self):
+        return self.tempo_map.bpm
+
+    @bpm.setter
+    def bpm(self, value):
+        self.tempo_map.set_tempo(0, value)
+
+    def snapshot(self):
+        """
+        Return the data of dump() as a read only Snapshot, only the changed
+        patterns are walked
+        """
+        return Snapshot({
             'name': self.name,
             'bpm': self.bpm,
-            'patterns': [p.dump() for p in self.patterns],
-            'patterns_seq': self.patterns_seq
+            'tempo': tuple(self.tempo_map.segments),
+            'patterns': tuple(p.snapshot() for p in self.patterns),
+            'patterns_seq': tuple(self.patterns_seq),
         })
 
+    def dump(self):
+        return thaw(self.snapshot())
+
     def load(self, data):
         self.name = data['name']
-        self.bpm = data.get('bpm', 120)
+        self.tempo_map = TempoMap(data.get('bpm', 120))
+        if data.get('tempo'):
+            self.tempo_map.load(data['tempo'])
         self.patterns = []
         for pattern in data['patterns']:
-            tmp_pattern = Pattern()
-            tmp_pattern.load(pattern)
-            self.patterns.append(tmp_pattern)
-        self.patterns_seq = data['patterns_seq']
+            # Patterns may come already built, see projectfile.open_project
+            if not isinstance(pattern, Pattern):
+                tmp_pattern = Pattern()
+                tmp_pattern.load(pattern)
+                pattern = tmp_pattern
+            self.patterns.append(pattern)
+        self.patterns_seq = list(data['patterns_seq'])
         self.rebuild_sequence()
 
     def rebuild_sequence(self):
@@ -98,37 +223,96 @@ class Project(object):
             i = j
         self._play_seq = tmp_play_seq
 
-    def bind(self):
-        for pattern in self.patterns:
-            pattern.bind()
-
-    def play_range(self, prev_time, curr_time):
+    def iter_events(self):
+        """
+        Yield (time, track, event, channel, note, velocity) for the whole song
+        in time order, generated one pattern at a time. Pattern changes yield
+        an EVENT_STOP entry for each track of the pattern being left.
+        """
         prev_pattern = None
         for pattern_start, pattern_end, pattern in self._play_seq:
-            if pattern_start > curr_time:
-                break
-            if pattern_end < prev_time:
-                continue
+            if prev_pattern is not None and prev_pattern is not pattern:
+                for track in prev_pattern.tracks:
+                    yield pattern_start, track, EVENT_STOP, None, None, None
+            prev_pattern = pattern
 
-            play_start = max(pattern_start, prev_time)
-            play_end = min(pattern_end, curr_time)
+            for entry in pattern.iter_events(pattern_start, pattern_end):
+                yield entry
 
-            if play_start >= play_end:
-                continue
+    def compile(self):
+        """
+        Compile one loop of every played pattern, times in an array that
+        play_range can bisect and the matching (track, event, channel, note,
+        velocity) entries in a parallel list, plus an array of the start
+        beats of patterns_seq. Only the patterns changed since the last call
+        are compiled again. Called on the UI thread: the new timeline is
+        swapped in with one assignment, so the player keeps playing the
+        previous one meanwhile.
+        """
+        play_seq = self._play_seq
+        timeline = self._timeline
+        changed = timeline is None or timeline[0] is not play_seq
+        compiled = {}
+        for pattern in self._played_patterns():
+            entry = self._compiled.get(pattern)
+            if entry is None or entry[0] != pattern.changes():
+                entry = _compile_pattern(pattern)
+                changed = True
+            compiled[pattern] = entry
+        # Drops the patterns the song no longer plays as well
+        self._compiled = compiled
+        if not changed:
+            return
+        if timeline is not None and timeline[0] is play_seq:
+            starts = timeline[1]
+        else:
+            starts = array('d', [start for start, end, p in play_seq])
+        self._timeline = (play_seq, starts, compiled)
 
-            if prev_pattern is None:
-                prev_pattern = pattern
+    def _played_patterns(self):
+        """
+        Return the patterns used by patterns_seq, each one once
+        """
+        patterns = []
+        seen = set()
+        for pattern_start, pattern_end, pattern in self._play_seq:
+            if id(pattern) not in seen:
+                seen.add(id(pattern))
+                patterns.append(pattern)
+        return patterns
 
-            if prev_pattern != pattern:
-                for track in prev_pattern.tracks:
-                    track.stop()
-                prev_pattern = pattern
+    def bind(self):
+        # Only what the song plays, the other patterns may stay unloaded
+        for pattern in self._played_patterns():
+            pattern.bind()
 
-            for track in pattern.tracks:
-                track.play_range(
-                    play_start - pattern_start,
-                    play_end - pattern_start
-                )
+    def play_range(self, prev_time, curr_time, offset=0):
+        # Never compiled here, see compile()
+        if self._timeline is None:
+            return
+        play_seq, starts, compiled = self._timeline
+        i = max(bisect_right(starts, prev_time) - 1, 0)
+        while i < len(play_seq):
+            pattern_start, pattern_end, pattern = play_seq[i]
+            if pattern_start >= curr_time:
+                break
+            key, times, entries, tracks = compiled[pattern]
+            if (pattern_start >= prev_time and i > 0 and
+                    play_seq[i - 1][2] is not pattern):
+                # Silence the pattern being left
+                for track in compiled[play_seq[i - 1][2]][3]:
+                    track.stop(offset + pattern_start - prev_time)
+            start = bisect_left(times, max(prev_time, pattern_start) -
+                                pattern_start)
+            end = bisect_left(times, min(curr_time, pattern_end) -
+                              pattern_start)
+            for j in xrange(start, end):
+                track, event, channel, note, velocity = entries[j]
+                if track._midi_port is not None:
+                    play_event(track._midi_port, event, channel, note,
+                               velocity,
+                               offset + pattern_start + times[j] - prev_time)
+            i += 1
 
     def mute(self):
         for pattern in self.patterns:
@@ -140,6 +324,57 @@ class Project(object):
         self.rebuild_sequence()
 
 
+def load_track(data):
+    """
+    Create a track from its dumped data
+    """
+    if data['track_type'] == TRACK_TYPE_DRUM:
+        return DrumTrack(
+            data['name'],
+            list(data['data']),
+            data.get('midi_port', 'Undefined'),
+            data.get('midi_channel', 0),
+            data['note'],
+        )
+    track = MidiTrack()
+    track.load(data)
+    return track
+
+
+def _freeze(data):
+    # Snapshot for a track read from a project file
+    return Snapshot((key, tuple(value) if isinstance(value, list) else value)
+                    for key, value in data.iteritems())
+
+
+def _compile_pattern(pattern):
+    # (changes(), times, entries, tracks) for one loop of the pattern, see
+    # Project.compile()
+    pattern.compile()
+    tracks = list(pattern.tracks)
+    events = list(pattern.iter_events())
+    return (pattern.changes(), array('d', [entry[0] for entry in events]),
+            [entry[1:] for entry in events], tracks)
+
+
+def _iter_track_loop(track, index, start, end):
+    # Track events repeated from start to end, tagged with the track index so
+    # merging them never compares tracks
+    track_len = track.len()
+    sequence = track.sequence()
+    if not track_len or not sequence:
+        return
+
+    loop_start = start
+    while loop_start < end:
+        for time, event, channel, note, velocity in sequence:
+            time += loop_start
+            if time >= end:
+                return
+            yield time, index, event, channel, note, velocity
+        loop_start += track_len
+
+
 def create_empty_pattern():
     tracks = [
         DrumTrack('Hi Hat', [' '] * 16, "", 15, 44),
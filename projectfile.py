@@ -0,0 +1,396 @@
+"""
+Binary project files.
+
+Converts the dict returned by Project.dump() to a compact binary file and
+back. The layout is:
+
+    header      magic, format version and pattern count
+    project     name, tempo and patterns_seq as JSON
+    index       offset, length and uid of every pattern
+    blocks      digest, layout, offset and length of every track data block
+    patterns    pattern and track info as JSON, each track followed by the
+                digest of its data block
+    data        track data blocks packed as little endian arrays, stored
+                once for all the tracks with the same data
+
+JSON files are still read, so old projects open as they are.
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+import sys
+from array import array
+from functools import partial
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+from project import Pattern
+from track import EventStore, TRACK_TYPE_DRUM, TRACK_TYPE_BASSLINE
+from sequencer_interface import MIDI_EVENT_NOTE_ON as NOTE_ON
+
+MAGIC = b'BKPF'
+VERSION = 2
+
+FILE_HEADER = struct.Struct('<4sHHI')
+INDEX_ENTRY = struct.Struct('<QIH')
+LENGTH = struct.Struct('<I')
+TRACK_HEADER = struct.Struct('<B')
+EVENTS_HEADER = struct.Struct('<II')
+BLOCK_ENTRY = struct.Struct('<20sBQI')
+DIGEST_SIZE = 20
+
+# How the track data is stored after the track info
+COLUMNS_NONE = 0
+COLUMNS_DRUM = 1
+COLUMNS_EVENTS = 2
+# Data in the block index, shared by every track with the same data
+COLUMNS_BLOCK = 3
+
+# EventStore columns in file order
+EVENT_COLUMNS = (
+    ('time_on', 'd'),
+    ('time_off', 'd'),
+    ('channel', 'H'),
+    ('note', 'h'),
+    ('velocity', 'i'),
+    ('type', 'B'),
+)
+
+_BIG_ENDIAN = sys.byteorder == 'big'
+
+
+class ProjectFileError(Exception):
+    pass
+
+
+def _pack_array(values):
+    if _BIG_ENDIAN:
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tostring()
+
+
+def _unpack_array(typecode, buf, pos, count):
+    values = array(typecode)
+    end = pos + count * values.itemsize
+    values.fromstring(buf[pos:end])
+    if _BIG_ENDIAN:
+        values.byteswap()
+    return values, end
+
+
+def _pack_json(data):
+    data = json.dumps(data)
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    return LENGTH.pack(len(data)) + data
+
+
+def _unpack_json(buf, pos):
+    size, = LENGTH.unpack_from(buf, pos)
+    pos += LENGTH.size
+    return json.loads(buf[pos:pos + size].decode('utf-8')), pos + size
+
+
+def _pack_columns(track):
+    """
+    Return (columns, payload, info): the packed track data and the track
+    info left for JSON
+    """
+    info = dict(track)
+    try:
+        if track['track_type'] == TRACK_TYPE_DRUM:
+            data = ''.join(track['data']).encode('ascii')
+            if len(data) != len(track['data']):
+                raise ValueError('Drum steps must be single characters')
+            del info['data']
+            return COLUMNS_DRUM, LENGTH.pack(len(data)) + data, info
+        elif track['track_type'] == TRACK_TYPE_BASSLINE:
+            store = track['data']
+            if not isinstance(store, EventStore):
+                store = EventStore(
+                    item if len(item) == 6 else _upgrade_item(item)
+                    for item in store
+                )
+            qmap = array('i', track['qmap'])
+            payload = [EVENTS_HEADER.pack(len(store), len(qmap)),
+                       _pack_array(qmap)]
+            for name, typecode in EVENT_COLUMNS:
+                payload.append(_pack_array(getattr(store, name)))
+            del info['data'], info['qmap']
+            return COLUMNS_EVENTS, b''.join(payload), info
+    except (ValueError, TypeError, OverflowError, UnicodeError, KeyError):
+        pass
+    # Anything that would not round trip stays in the JSON info
+    return COLUMNS_NONE, b'', track
+
+
+def _pack_track(track, blocks):
+    columns, payload, info = _pack_columns(track)
+    if columns == COLUMNS_NONE:
+        return TRACK_HEADER.pack(columns) + _pack_json(info)
+
+    digest = hashlib.sha1(chr(columns) + payload).digest()
+    blocks[digest] = (columns, payload)
+    return TRACK_HEADER.pack(COLUMNS_BLOCK) + _pack_json(info) + digest
+
+
+def _upgrade_item(item):
+    # Events saved before channels and event types were stored
+    if len(item) == 4:
+        time_on, time_off, note, velocity = item
+        channel = 0
+    else:
+        time_on, time_off, channel, note, velocity = item
+    return (time_on, time_off, channel, note, velocity, NOTE_ON)
+
+
+def pack_pattern(pattern, blocks):
+    """
+    Return the file contents for a Pattern.dump() dict or snapshot. The
+    track data goes to blocks as {digest: (columns, payload)}, to be written
+    once per file by join().
+    """
+    info = dict(pattern)
+    tracks = info.pop('tracks')
+    return b''.join(
+        [_pack_json(info), LENGTH.pack(len(tracks))] +
+        [_pack_track(track, blocks) for track in tracks]
+    )
+
+
+def dumps(data):
+    """
+    Return the binary file contents for a Project.dump() dict or snapshot
+    """
+    info = dict(data)
+    blocks = {}
+    patterns = [(p.get('uid'), pack_pattern(p, blocks))
+                for p in info.pop('patterns')]
+    return join(info, patterns, blocks)
+
+
+def join(info, patterns, blocks):
+    """
+    Return the binary file contents for the project info (Project.dump()
+    without patterns), a list of (uid, pack_pattern() contents) and the
+    blocks filled by pack_pattern()
+    """
+    uids = [(uid or '').encode('utf-8') for uid, pattern in patterns]
+    patterns = [pattern for uid, pattern in patterns]
+    blocks = sorted(blocks.items())
+    info = _pack_json(info)
+
+    pos = (FILE_HEADER.size + len(info) +
+           sum(INDEX_ENTRY.size + len(uid) for uid in uids) +
+           LENGTH.size + BLOCK_ENTRY.size * len(blocks))
+    index = []
+    for uid, pattern in zip(uids, patterns):
+        index.append(INDEX_ENTRY.pack(pos, len(pattern), len(uid)) + uid)
+        pos += len(pattern)
+
+    block_index = [LENGTH.pack(len(blocks))]
+    for digest, (columns, payload) in blocks:
+        block_index.append(BLOCK_ENTRY.pack(digest, columns, pos,
+                                            len(payload)))
+        pos += len(payload)
+
+    header = FILE_HEADER.pack(MAGIC, VERSION, 0, len(patterns))
+    return b''.join([header, info] + index + block_index + patterns +
+                    [payload for digest, (columns, payload) in blocks])
+
+
+class ProjectReader(object):
+    """
+    Reads a binary project file from a string or a memory map.
+
+    The project info, the pattern index and the block index are read up
+    front, the patterns when asked for. Tracks with the same events read by
+    the same reader share one EventStore.
+    """
+    def __init__(self, buf):
+        magic, version, flags, count = FILE_HEADER.unpack_from(buf, 0)
+        if magic != MAGIC:
+            raise ProjectFileError('Not a beatkit project file')
+        if version > VERSION:
+            raise ProjectFileError(
+                'Project file version {} is not supported'.format(version))
+
+        self.buf = buf
+        self.info, pos = _unpack_json(buf, FILE_HEADER.size)
+        # [(uid, offset, length)]
+        self.index = []
+        for i in xrange(count):
+            offset, length, uid_len = INDEX_ENTRY.unpack_from(buf, pos)
+            pos += INDEX_ENTRY.size
+            uid = buf[pos:pos + uid_len].decode('utf-8')
+            pos += uid_len
+            self.index.append((uid, offset, length))
+
+        # digest -> (columns, offset), version 1 files keep the data inline
+        self.blocks = {}
+        if version >= 2:
+            count, = LENGTH.unpack_from(buf, pos)
+            pos += LENGTH.size
+            for i in xrange(count):
+                digest, columns, offset, length = BLOCK_ENTRY.unpack_from(
+                    buf, pos)
+                pos += BLOCK_ENTRY.size
+                self.blocks[digest] = (columns, offset)
+        self._stores = {}
+
+    def pattern_info(self, pos):
+        """
+        Read the name, length and uid of the pattern stored at pos, without
+        its tracks
+        """
+        return _unpack_json(self.buf, pos)[0]
+
+    def pattern(self, pos, events=False):
+        """
+        Read the pattern stored at pos. With events=True the MidiTrack
+        events are returned as an EventStore, ready for MidiTrack.load,
+        instead of lists.
+        """
+        pattern, pos = _unpack_json(self.buf, pos)
+        count, = LENGTH.unpack_from(self.buf, pos)
+        pos += LENGTH.size
+        pattern['tracks'] = []
+        for i in xrange(count):
+            track, pos = self._track(pos, events)
+            pattern['tracks'].append(track)
+        return pattern
+
+    def _track(self, pos, events):
+        buf = self.buf
+        columns, = TRACK_HEADER.unpack_from(buf, pos)
+        track, pos = _unpack_json(buf, pos + TRACK_HEADER.size)
+        if columns == COLUMNS_NONE:
+            return track, pos
+
+        if columns == COLUMNS_BLOCK:
+            digest = buf[pos:pos + DIGEST_SIZE]
+            pos += DIGEST_SIZE
+            try:
+                columns, offset = self.blocks[digest]
+            except KeyError:
+                raise ProjectFileError('Missing track data block')
+            self._unpack_columns(track, columns, offset, events, digest)
+        else:
+            pos = self._unpack_columns(track, columns, pos, events)
+        return track, pos
+
+    def _unpack_columns(self, track, columns, pos, events, digest=None):
+        buf = self.buf
+        if columns == COLUMNS_DRUM:
+            size, = LENGTH.unpack_from(buf, pos)
+            pos += LENGTH.size
+            track['data'] = list(buf[pos:pos + size].decode('ascii'))
+            return pos + size
+        elif columns != COLUMNS_EVENTS:
+            raise ProjectFileError('Unknown track layout {}'.format(columns))
+
+        rows, qmap_len = EVENTS_HEADER.unpack_from(buf, pos)
+        pos += EVENTS_HEADER.size
+        qmap, pos = _unpack_array('i', buf, pos, qmap_len)
+        track['qmap'] = qmap.tolist()
+        store = self._stores.get(digest)
+        if store is None:
+            store = EventStore()
+            for name, typecode in EVENT_COLUMNS:
+                column, pos = _unpack_array(typecode, buf, pos, rows)
+                setattr(store, name, column)
+            if digest is not None:
+                self._stores[digest] = store
+        if digest is not None:
+            # Never hand out the cached store itself, it must not change
+            store = store.share()
+        track['data'] = store if events else store.dump()
+        return pos
+
+
+def loads(buf, events=False):
+    """
+    Return the Project.dump() dict stored in a binary file
+    """
+    reader = ProjectReader(buf)
+    data = dict(reader.info)
+    data['patterns'] = [reader.pattern(offset, events)
+                        for uid, offset, length in reader.index]
+    return data
+
+
+def is_project_file(buf):
+    return buf[:len(MAGIC)] == MAGIC
+
+
+def save(data, filename):
+    write_file(filename, dumps(data))
+
+
+def write_file(filename, contents):
+    """
+    Write through a temporary file, so a failed save never leaves a broken
+    file and projects mapped by open_project stay valid
+    """
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        f.write(contents)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_filename, filename)
+
+
+def load(filename, events=False):
+    """
+    Read a binary or JSON project file
+    """
+    with open(filename, 'rb') as f:
+        buf = f.read()
+    if is_project_file(buf):
+        return loads(buf, events)
+    return json.loads(buf.decode('utf-8'))
+
+
+def open_project(filename):
+    """
+    Read a project file for Project.load without loading the patterns.
+
+    Binary files are memory mapped: only the project info and the pattern
+    names are read now, each pattern builds its tracks from the mapped file
+    when they are first used. JSON files are read as a whole.
+    """
+    with open(filename, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            f.seek(0)
+            return json.loads(f.read().decode('utf-8'))
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    reader = ProjectReader(buf)
+    data = dict(reader.info)
+    data['patterns'] = []
+    for uid, offset, length in reader.index:
+        info = reader.pattern_info(offset)
+        pattern = Pattern(info['name'], None, info['len'], info.get('uid'))
+        pattern.load_lazy(partial(reader.pattern, offset))
+        data['patterns'].append(pattern)
+    return data
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print "Usage: {} input output".format(sys.argv[0])
+        print "Converts to JSON when output ends with .json, else to binary"
+        sys.exit(1)
+
+    data = load(sys.argv[1])
+    if sys.argv[2].endswith('.json'):
+        with open(sys.argv[2], 'w') as f:
+            f.write(json.dumps(data, indent=2))
+    else:
+        save(data, sys.argv[2])
@@ -1,4 +1,5 @@
 import threading
+from collections import OrderedDict
 
 import pygame_sdl2 as pygame
 from util import set_thread_name
@@ -13,64 +14,220 @@ EXIT_FIELD_KEYS = [
 
 FONT_NAME = 'SpaceMono-Bold.ttf'
 
+BACKGROUND = (0, 0, 0)
+TEXT_COLOR = (255, 255, 255)
+BOLD_COLOR = (255, 255, 31)
+
+# Printable ASCII, pre-rendered once per color in a glyph strip
+ATLAS_CHARS = ''.join(chr(c) for c in xrange(32, 127))
+ATLAS_INDEX = dict((c, i) for i, c in enumerate(ATLAS_CHARS))
+# Runs of text this long are rendered whole and kept in a small LRU cache
+LONG_TEXT = 16
+RENDER_CACHE_SIZE = 128
+
+# Font size -> cell size (width, height) of FONT_NAME
+_font_metrics = {}
+
 
 class Screen():
+    """
+    Character cell screen.
+
+    addstr() and erase() only write to a grid of cells. refresh() compares
+    the grid with what is on the display, draws the span of every row that
+    changed and sends just those rectangles to the window.
+
+    Text is composed from a strip of glyphs rendered once per color, so
+    memory does not grow with the strings shown. Only long runs are
+    rendered whole, and just the most recent of them are kept.
+    """
     def __init__(self):
         self.frames = 120
         size = self.width, self.height = 1024, 700
         self.screen = pygame.display.set_mode(size, pygame.RESIZABLE)
         self.clock = pygame.time.Clock()
+        self.erase_count = 0
+        self._fonts = {}
         self.set_font_size(16)
 
     def set_font_size(self, size):
-        self.font = pygame.font.Font(FONT_NAME, size)
-        self.ux, self.uy = self.font.size('#')
-        self._font_render_cache = {}
+        self.font = self._fonts.get(size)
+        if self.font is None:
+            self.font = self._fonts[size] = pygame.font.Font(FONT_NAME, size)
+        self.font_size = size
+        self.ux, self.uy = font_metrics(size, self.font)
+        self._atlas = {}
+        self._render_cache = OrderedDict()
+        self._reset_cells()
+
+    def _reset_cells(self):
+        """
+        Start a blank grid for the current window and font size, the whole
+        window is sent on the next refresh
+        """
+        self.cols = max(1, self.width // self.ux)
+        self.rows = max(1, self.height // self.uy)
+        self.erase()
+        # Rows as they are on the display
+        self._shown_chars = [[' '] * self.cols for y in xrange(self.rows)]
+        self._shown_attrs = [[False] * self.cols for y in xrange(self.rows)]
+        self._flip = True
+        self.screen.fill(BACKGROUND)
 
     def find_font_size(self, cols, rows):
         """
         Find the font size for the needed cols and rows on current resolution
         """
-        tmp_size = 1
-        ux, uy = pygame.font.Font(FONT_NAME, tmp_size).size('#')
-        cols_ux, rows_uy = ux * cols, uy * rows
-        while cols_ux < self.width and rows_uy < self.height:
-            size = tmp_size
-            tmp_size += 1
-            ux, uy = pygame.font.Font(FONT_NAME, tmp_size).size('#')
-            cols_ux, rows_uy = ux * cols, uy * rows
+        def fits(size):
+            ux, uy = font_metrics(size)
+            return ux * cols < self.width and uy * rows < self.height
+
+        # Cells grow with the font size: find a size that does not fit, then
+        # bisect for the largest one that does
+        low, high = 1, 2
+        while fits(high):
+            low, high = high, high * 2
+        high -= 1
+        while low < high:
+            size = (low + high + 1) // 2
+            if fits(size):
+                low = size
+            else:
+                high = size - 1
 
-        self.set_font_size(size)
+        if low != self.font_size:
+            self.set_font_size(low)
 
     def timeout(self, time):
         self.frames = time
 
     def addstr(self, y, x, text, attr=None):
-        color = (255, 255, 31) if bool(attr) else (255, 255, 255)
-        text_key = (text, color)
+        if not 0 <= y < self.rows or not 0 <= x < self.cols:
+            return
+
+        text = text[:self.cols - x]
+        end = x + len(text)
+        self._chars[y][x:end] = text
+        self._attrs[y][x:end] = [bool(attr)] * len(text)
+        self._dirty.add(y)
 
-        text_render = self._font_render_cache.get(text_key, None)
-        if not text_render:
-            text_render = self.font.render(text, False, color, (0, 0, 0))
-            self._font_render_cache[text_key] = text_render
+    def clrtoeol(self, y, x=0):
+        """
+        Blank row y from column x to the end
+        """
+        if x < self.cols:
+            self.addstr(y, x, ' ' * (self.cols - x))
 
-        x1, y1 = self.ux*x, self.uy*y
-        w, h = text_render.get_size()
-        self.screen.fill(pygame.Color("black"), (x1, y1, w, h))
-        self.screen.blit(text_render, (x1, y1))
+    def clrtobot(self, y):
+        """
+        Blank every row from y to the bottom
+        """
+        for row in xrange(max(y, 0), self.rows):
+            self.clrtoeol(row)
+
+    def touchwin(self):
+        """
+        Send every cell again on the next refresh, for when the window lost
+        its contents
+        """
+        self._shown_chars = [[None] * self.cols for y in xrange(self.rows)]
+        self._dirty.update(xrange(self.rows))
+        self._flip = True
 
     def refresh(self, *args):
-        pygame.display.flip()
+        rects = []
+        for y in self._dirty:
+            chars, attrs = self._chars[y], self._attrs[y]
+            shown_chars = self._shown_chars[y]
+            shown_attrs = self._shown_attrs[y]
+            if chars == shown_chars and attrs == shown_attrs:
+                continue
+
+            start, end = 0, self.cols
+            while (chars[start] == shown_chars[start] and
+                   attrs[start] == shown_attrs[start]):
+                start += 1
+            while (chars[end-1] == shown_chars[end-1] and
+                   attrs[end-1] == shown_attrs[end-1]):
+                end -= 1
+            rects.append(self._draw(y, start, end))
+            shown_chars[start:end] = chars[start:end]
+            shown_attrs[start:end] = attrs[start:end]
+        self._dirty.clear()
+
+        if self._flip:
+            pygame.display.flip()
+            self._flip = False
+        elif rects:
+            pygame.display.update(rects)
         self.clock.tick(self.frames)
 
+    def _draw(self, y, start, end):
+        """
+        Draw the cells start to end of row y, return the rectangle drawn
+        """
+        chars, attrs = self._chars[y], self._attrs[y]
+        rect = pygame.Rect(self.ux*start, self.uy*y,
+                           self.ux*(end - start), self.uy)
+        self.screen.fill(BACKGROUND, rect)
+        x = start
+        while x < end:
+            attr = attrs[x]
+            run = x + 1
+            while run < end and attrs[run] == attr:
+                run += 1
+            text = ''.join(chars[x:run])
+            if text.strip():
+                self._blit_text(text, attr, self.ux*x, self.uy*y)
+            x = run
+        return rect
+
+    def _blit_text(self, text, attr, x, y):
+        if len(text) >= LONG_TEXT:
+            self.screen.blit(self._render(text, attr), (x, y))
+            return
+
+        ux, uy = self.ux, self.uy
+        atlas = self._atlas.get(attr)
+        if atlas is None:
+            atlas = self._atlas[attr] = self._render(ATLAS_CHARS, attr,
+                                                     cache=False)
+        for c in text:
+            if c != ' ':
+                i = ATLAS_INDEX.get(c)
+                if i is None:
+                    self.screen.blit(self._render(c, attr), (x, y))
+                else:
+                    self.screen.blit(atlas, (x, y), (ux*i, 0, ux, uy))
+            x += ux
+
+    def _render(self, text, attr, cache=True):
+        if not cache:
+            color = BOLD_COLOR if attr else TEXT_COLOR
+            return self.font.render(text, False, color, BACKGROUND)
+
+        key = (text, attr)
+        text_render = self._render_cache.pop(key, None)
+        if text_render is None:
+            text_render = self._render(text, attr, cache=False)
+            if len(self._render_cache) >= RENDER_CACHE_SIZE:
+                self._render_cache.popitem(last=False)
+        self._render_cache[key] = text_render
+        return text_render
+
     def resize(self, width, height):
         size = self.width, self.height = width, height
         print size
         self.screen = pygame.display.set_mode(size, pygame.RESIZABLE)
+        self._reset_cells()
         self.refresh()
 
     def erase(self):
-        self.screen.fill(pygame.Color("black"))
+        # Lets views that keep what they drew know the screen was wiped
+        self.erase_count += 1
+        self._chars = [[' '] * self.cols for y in xrange(self.rows)]
+        self._attrs = [[False] * self.cols for y in xrange(self.rows)]
+        self._dirty = set(xrange(self.rows))
 
     def textbox(self, y, x, width, value="", edit=False):
         # Draw a textbox and return the exit key
@@ -156,6 +313,19 @@ class Screen():
         return k, value
 
 
+def font_metrics(size, font=None):
+    """
+    Return the cell size of FONT_NAME at size, loading the font only the
+    first time
+    """
+    metrics = _font_metrics.get(size)
+    if metrics is None:
+        if font is None:
+            font = pygame.font.Font(FONT_NAME, size)
+        metrics = _font_metrics[size] = font.size('#')
+    return metrics
+
+
 def noecho():
     pass
 
@@ -283,13 +453,20 @@ class Menu(object):
         self.scr.refresh(0, 0, 0, 0, 30, 100)
 
     def mprint(self, y, x, menu):
-        attr = 0
-        for i, c in enumerate(menu):
-            if c == '_':
-                attr = keys.A_BOLD
-            else:
-                self.scr.addstr(y, x+i, c, attr)
-                attr = 0
+        # '_' takes a cell and makes the next character bold. Write the
+        # plain text between them in one go
+        parts = menu.split('_')
+        text = parts[0]
+        for part in parts[1:]:
+            if text:
+                self.scr.addstr(y, x, text)
+            x += len(text) + 1
+            if part:
+                self.scr.addstr(y, x, part[0], keys.A_BOLD)
+                x += 1
+            text = part[1:]
+        if text:
+            self.scr.addstr(y, x, text)
 
 
 if __name__ == "__main__":
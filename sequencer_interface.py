@@ -1,28 +1,294 @@
-from pyalsa import alsaseq
+import fcntl
+import os
+import threading
+import time
+from array import array
+from collections import deque
+from contextlib import contextmanager
 
-MIDI_EVENT_NOTE_ON = alsaseq.SEQ_EVENT_NOTEON
-MIDI_EVENT_NOTE_OFF = alsaseq.SEQ_EVENT_NOTEOFF
-MIDI_EVENT_CONTROLLER = alsaseq.SEQ_EVENT_CONTROLLER
-MIDI_EVENT_PITCH = alsaseq.SEQ_EVENT_PITCHBEND
+try:
+    from pyalsa import alsaseq
+except ImportError:
+    alsaseq = None
 
-SEQ_PORT_CAP_WRITE = alsaseq.SEQ_PORT_CAP_WRITE
-SEQ_PORT_CAP_SUBS_WRITE = alsaseq.SEQ_PORT_CAP_SUBS_WRITE
-SEQ_PORT_CAP_READ = alsaseq.SEQ_PORT_CAP_READ
-SEQ_PORT_CAP_SUBS_READ = alsaseq.SEQ_PORT_CAP_SUBS_READ
-SEQ_PORT_TYPE_APPLICATION = alsaseq.SEQ_PORT_TYPE_APPLICATION
+# ALSA sequencer event types and port flags. Defined here so the memory
+# backend works without pyalsa installed.
+MIDI_EVENT_NOTE_ON = 6
+MIDI_EVENT_NOTE_OFF = 7
+MIDI_EVENT_CONTROLLER = 10
+MIDI_EVENT_PITCH = 13
 
-SeqEvent = alsaseq.SeqEvent
+SEQ_PORT_CAP_READ = 1 << 0
+SEQ_PORT_CAP_WRITE = 1 << 1
+SEQ_PORT_CAP_SUBS_READ = 1 << 5
+SEQ_PORT_CAP_SUBS_WRITE = 1 << 6
+SEQ_PORT_TYPE_APPLICATION = 1 << 20
 
+# Events read from the sequencer per receive call
+INPUT_BATCH = 256
 
-class SequencerInterface:
+
+class InputEvent(object):
+    """
+    Received MIDI event, with the same interface as pyalsa's SeqEvent
+    """
+    __slots__ = ('type', 'data')
+
+    def __init__(self, event_type, data):
+        self.type = event_type
+        self.data = data
+
+    def get_data(self):
+        return self.data
+
+
+class SequencerBackend(object):
+    """
+    Base MIDI output backend.
+
+    Takes care of event batching, flush counters and the lookahead schedule;
+    backends implement _output() to write one event, _drain() to deliver
+    everything written so far and the port handling methods.
+
+    The player and UI threads both send events. Writing, draining and the
+    pending count are serialized by a lock, and each thread has its own
+    batch depth so one thread's batch never holds back the other's events.
+    """
     def __init__(self, name):
+        self.name = name
+        self.client_id = None
+        self.ports = {}
+        self._schedule = None
+        self._capture = None
+        # Called with the offset of every play window event before it is sent
+        self.monitor = None
+        self._lock = threading.RLock()
+        self._batches = threading.local()
+        self._pending = 0
+        # Output counters, see flush_stats()
+        self.flushes = 0
+        self.flushed_events = 0
+        self.max_flush_events = 0
+
+    @contextmanager
+    def batch(self):
+        """
+        Queue the events sent inside the block and drain them all at once
+        when the outermost batch ends
+        """
+        depth = getattr(self._batches, 'depth', 0)
+        self._batches.depth = depth + 1
+        try:
+            yield
+        finally:
+            self._batches.depth = depth
+            if not depth:
+                self.flush()
+
+    def flush(self):
+        """
+        Drain the queued events to the sequencer
+        """
+        with self._lock:
+            if not self._pending:
+                return
+
+            self._drain()
+            self.flushes += 1
+            self.flushed_events += self._pending
+            self.max_flush_events = max(self.max_flush_events, self._pending)
+            self._pending = 0
+
+    def flush_stats(self):
+        return {
+            'flushes': self.flushes,
+            'events': self.flushed_events,
+            'max_events': self.max_flush_events,
+            'events_per_flush': (
+                float(self.flushed_events) / self.flushes
+                if self.flushes else 0.
+            ),
+        }
+
+    def start_queue(self):
+        """
+        Get ready to deliver timestamped events
+        """
+        pass
+
+    def stop_queue(self):
+        self.drop_output()
+
+    def close(self):
+        """
+        Release what the backend holds open, it can't be used afterwards
+        """
+        pass
+
+    def schedule(self, base, seconds_per_beat):
+        """
+        Timestamp the following events instead of sending them right away.
+
+        Events sent with an offset (in beats from the start of the current
+        play window) are delivered by the queue (base + offset) beats after
+        they are posted. base is usually negative or zero: the distance from
+        the transport position to the start of the play window.
+        """
+        self._schedule = (base, seconds_per_beat)
+
+    def unschedule(self):
+        self._schedule = None
+
+    def drop_output(self):
+        """
+        Drop all events still waiting to be delivered
+        """
+        with self._lock:
+            self._pending = 0
+
+    def output_ports(self):
+        """
+        Return {name: (client_id, port_id)} for the ports we can send to
+        """
+        return {}
+
+    def create_output(self, name):
+        pass
+
+    def connect(self, port, dest_id, dest_port):
+        pass
+
+    def register_input(self, poller):
+        """
+        Register the input file descriptors in a select.poll object
+        """
+        pass
+
+    def input_events(self):
+        """
+        Return every MIDI event waiting to be read, without blocking
+        """
+        return []
+
+    def capture(self, callback):
+        """
+        Hand the following play window events to callback(port, event_type,
+        channel, param, value, offset) instead of sending them. Events sent
+        without an offset are not affected.
+        """
+        self._capture = callback
+
+    def release(self):
+        self._capture = None
+
+    def send_output(self, port, event_type, channel, param, value,
+                    offset=None):
+        if not isinstance(port, int):
+            return
+
+        if offset is not None and self._capture is not None:
+            self._capture(port, event_type, channel, param, value, offset)
+            return
+
+        if offset is not None and self.monitor is not None:
+            self.monitor(offset)
+
+        delay = None
+        if offset is not None and self._schedule is not None:
+            base, seconds_per_beat = self._schedule
+            delay = max(0., (base + offset) * seconds_per_beat)
+
+        self.send_delayed(port, event_type, channel, param, value, delay)
+
+    def send_delayed(self, port, event_type, channel, param, value, delay):
+        """
+        Send an event delay seconds from now, or right away when delay is
+        None
+        """
+        if delay is not None:
+            self.start_queue()
+        with self._lock:
+            self._output(port, event_type, channel, param, value, delay)
+            self._pending += 1
+        if not getattr(self._batches, 'depth', 0):
+            self.flush()
+
+    def _output(self, port, event_type, channel, param, value, delay):
+        raise NotImplementedError
+
+    def _drain(self):
+        pass
+
+    def note_on(self, port, note, channel, velocity, offset=None):
+        self.send_output(port, MIDI_EVENT_NOTE_ON, channel, note, velocity,
+                         offset)
+
+    def note_off(self, port, note, channel, offset=None):
+        self.send_output(port, MIDI_EVENT_NOTE_OFF, channel, note, 0, offset)
+
+    def set_control(self, port, value, param, channel, offset=None):
+        self.send_output(port, MIDI_EVENT_CONTROLLER, channel, param, value,
+                         offset)
+
+    def set_pitchbend(self, port, value, channel, offset=None):
+        self.send_output(port, MIDI_EVENT_PITCH, channel, 0, value, offset)
+
+
+class SequencerInterface(SequencerBackend):
+    """
+    ALSA sequencer backend
+    """
+    def __init__(self, name):
+        super(SequencerInterface, self).__init__(name)
         self.seq = alsaseq.Sequencer(clientname=name)
+        self.client_id = self.seq.client_id
         self.intput = self.seq.create_simple_port(
             'Midi Input',
             SEQ_PORT_TYPE_APPLICATION,
             SEQ_PORT_CAP_WRITE | SEQ_PORT_CAP_SUBS_WRITE,
         )
-        self.ports = {}
+        self.queue = None
+
+    def start_queue(self):
+        """
+        Create and start the queue used to deliver timestamped events
+        """
+        if self.queue is None:
+            self.queue = self.seq.create_queue(self.name)
+            self.seq.start_queue(self.queue)
+        return self.queue
+
+    def stop_queue(self):
+        if self.queue is None:
+            return
+        self.drop_output()
+        self.seq.delete_queue(self.queue)
+        self.queue = None
+
+    def drop_output(self):
+        with self._lock:
+            self._pending = 0
+            try:
+                self.seq.drop_output()
+            except alsaseq.SequencerError:
+                pass
+
+    def output_ports(self):
+        ports = {}
+        required_cap = SEQ_PORT_CAP_WRITE | SEQ_PORT_CAP_SUBS_WRITE
+
+        for client_name, client_id, client_ports in self.seq.connection_list():
+            for port_name, port_id, properties in client_ports:
+                capability = self.seq.get_port_info(
+                    port_id, client_id).get('capability', 0)
+                if capability & required_cap == required_cap:
+                    if port_name.startswith(client_name):
+                        name = port_name
+                    else:
+                        name = "{} - {}".format(client_name, port_name)
+                    ports[name] = (client_id, port_id)
+
+        return ports
 
     def create_output(self, name):
         port_id = self.seq.create_simple_port(
@@ -37,45 +303,144 @@ class SequencerInterface:
         self.seq.connect_ports((self.seq.client_id, port),
                                (dest_id, dest_port))
 
-    def event_input(self):
-        return self.seq.receive_events(timeout=250, maxevents=10)
+    def register_input(self, poller):
+        self.seq.registerpoll(poller, input=True)
 
-    def send_output(self, port, event_type, event_data):
-        if not isinstance(port, int):
-            return
+    def input_events(self):
+        events = []
+        while True:
+            received = self.seq.receive_events(timeout=0,
+                                               maxevents=INPUT_BATCH)
+            events.extend(received)
+            if len(received) < INPUT_BATCH:
+                return events
 
-        ev = SeqEvent(type=event_type)
+    def _output(self, port, event_type, channel, param, value, delay):
+        if delay is not None:
+            ev = alsaseq.SeqEvent(event_type, alsaseq.SEQ_TIME_STAMP_REAL,
+                                  alsaseq.SEQ_TIME_MODE_REL)
+            ev.queue = self.queue
+            ev.time = delay
+        else:
+            ev = alsaseq.SeqEvent(type=event_type)
         ev.source = (self.seq.client_id, port)
-        ev.set_data(event_data)
-        self.seq.output_event(ev)
+
+        if event_type in (MIDI_EVENT_NOTE_ON, MIDI_EVENT_NOTE_OFF):
+            ev.set_data({
+                'note.channel': channel,
+                'note.note': param,
+                'note.velocity': value,
+            })
+        else:
+            ev.set_data({
+                'control.value': value,
+                'control.param': param,
+                'control.channel': channel,
+            })
+
+        try:
+            self.seq.output_event(ev)
+        except alsaseq.SequencerError:
+            # Output buffer is full, make room and try again
+            self._drain()
+            self.seq.output_event(ev)
+
+    def _drain(self):
         try:
             self.seq.drain_output()
         except alsaseq.SequencerError:
             pass
 
-    def note_on(self, port, note, channel, velocity):
-        self.send_output(port, MIDI_EVENT_NOTE_ON, {
-            'note.channel': channel,
-            'note.note': note,
-            'note.velocity': velocity,
-        })
-
-    def note_off(self, port, note, channel):
-        self.send_output(port, MIDI_EVENT_NOTE_OFF, {
-            'note.channel': channel,
-            'note.note': note,
-            'note.velocity': 0,
-        })
-
-    def set_control(self, port, value, param, channel):
-        self.send_output(port, MIDI_EVENT_CONTROLLER, {
-            'control.value': value,
-            'control.param': param,
-            'control.channel': channel,
-        })
-
-    def set_pitchbend(self, port, value, channel):
-        self.send_output(port, MIDI_EVENT_PITCH, {
-            'control.value': value,
-            'control.channel': channel,
-        })
+
+class MemorySequencer(SequencerBackend):
+    """
+    Backend that records the events instead of playing them.
+
+    Every event is stored as a row of parallel arrays: delivery time (send
+    time plus the scheduled delay), port, type, channel, param (note or
+    controller) and value (velocity or controller value). Used to run and
+    measure playback without a sound stack.
+    """
+    def __init__(self, name, clock=time.time):
+        super(MemorySequencer, self).__init__(name)
+        self.client_id = 0
+        self.clock = clock
+        self.dropped = 0
+        self._input = deque()
+        self._input_pipe = os.pipe()
+        for fd in self._input_pipe:
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.clear()
+
+    def clear(self):
+        self.times = array('d')
+        self.port_ids = array('i')
+        self.types = array('B')
+        self.channels = array('H')
+        self.params = array('i')
+        self.values = array('i')
+
+    def __len__(self):
+        return len(self.times)
+
+    def events(self):
+        """
+        Return a list of (time, port, type, channel, param, value)
+        """
+        return zip(self.times, self.port_ids, self.types, self.channels,
+                   self.params, self.values)
+
+    def drop_output(self):
+        with self._lock:
+            self._pending = 0
+            self.dropped += 1
+
+    def output_ports(self):
+        return dict((name, (self.client_id, port_id))
+                    for name, port_id in self.ports.items())
+
+    def create_output(self, name):
+        port_id = len(self.ports)
+        self.ports[name] = port_id
+        return port_id
+
+    def feed_input(self, events):
+        """
+        Make events (InputEvent or SeqEvent like objects) available to
+        input_events() and wake up whoever polls the input
+        """
+        self._input.extend(events)
+        try:
+            os.write(self._input_pipe[1], b'x')
+        except OSError:
+            # Pipe full, the reader is awake already
+            pass
+
+    def close(self):
+        if self._input_pipe is None:
+            return
+        for fd in self._input_pipe:
+            os.close(fd)
+        self._input_pipe = None
+
+    def register_input(self, poller):
+        poller.register(self._input_pipe[0])
+
+    def input_events(self):
+        try:
+            os.read(self._input_pipe[0], 4096)
+        except OSError:
+            pass
+        events = []
+        while self._input:
+            events.append(self._input.popleft())
+        return events
+
+    def _output(self, port, event_type, channel, param, value, delay):
+        self.times.append(self.clock() + (delay or 0.))
+        self.port_ids.append(port)
+        self.types.append(event_type)
+        self.channels.append(channel)
+        self.params.append(param or 0)
+        self.values.append(value)
@@ -0,0 +1,131 @@
+"""
+Tempo map.
+
+Converts between song beats and transport frames when the tempo changes
+along the song.
+"""
+
+from array import array
+from bisect import bisect_right
+
+DEFAULT_SAMPLERATE = 48000
+
+
+class TempoMap(object):
+    """
+    Tempo segments, each one starting at a beat with a constant bpm.
+
+    The frame where every segment starts is precomputed, so converting a
+    beat to a frame or back is a bisect over the anchors plus a multiply.
+    Beats are eighth notes, like everywhere else in beatkit.
+    """
+    def __init__(self, bpm=120, samplerate=DEFAULT_SAMPLERATE):
+        self.samplerate = samplerate
+        self.segments = [(0., bpm)]
+        self._rebuild()
+
+    def _rebuild(self):
+        self._beats = array('d')
+        self._frames = array('d')
+        self._bpms = array('d')
+        frame = 0.
+        prev_beat, prev_bpm = self.segments[0]
+        for beat, bpm in self.segments:
+            frame += (beat - prev_beat) * self.frames_per_beat(prev_bpm)
+            self._beats.append(beat)
+            self._frames.append(frame)
+            self._bpms.append(bpm)
+            prev_beat, prev_bpm = beat, bpm
+
+    def frames_per_beat(self, bpm):
+        return self.samplerate * 30. / bpm
+
+    def copy(self, samplerate=None):
+        tempo_map = TempoMap(samplerate=samplerate or self.samplerate)
+        tempo_map.segments = list(self.segments)
+        tempo_map._rebuild()
+        return tempo_map
+
+    @property
+    def bpm(self):
+        """
+        Tempo at the start of the song
+        """
+        return self.segments[0][1]
+
+    def bpm_at(self, beat):
+        return self._bpms[max(bisect_right(self._beats, beat) - 1, 0)]
+
+    def set_tempo(self, beat, bpm):
+        """
+        Change the tempo from beat until the next tempo change
+        """
+        _check_bpm(bpm)
+        beat = max(float(beat), 0.)
+        segments = [s for s in self.segments if s[0] != beat]
+        segments.append((beat, bpm))
+        segments.sort()
+        self.segments = segments
+        self._rebuild()
+
+    def set_ramp(self, start_beat, start_bpm, end_beat, end_bpm, steps=None):
+        """
+        Change the tempo gradually between two beats, one step per beat by
+        default. The tempo stays at end_bpm from end_beat on.
+        """
+        _check_bpm(start_bpm)
+        _check_bpm(end_bpm)
+        start_beat, end_beat = float(start_beat), float(end_beat)
+        if end_beat < start_beat:
+            raise ValueError('Ramp ends at beat {} before it starts at {}'
+                             .format(end_beat, start_beat))
+        steps = steps or max(int(end_beat - start_beat), 1)
+        self.segments = [s for s in self.segments
+                         if not start_beat <= s[0] <= end_beat]
+        for i in xrange(steps):
+            self.segments.append((
+                start_beat + (end_beat - start_beat) * i / steps,
+                start_bpm + float(end_bpm - start_bpm) * i / steps,
+            ))
+        self.segments.append((end_beat, end_bpm))
+        self.segments.sort()
+        self._rebuild()
+
+    def change_tempo(self, beat, bpm):
+        """
+        Live tempo change: play at bpm from beat on, dropping later changes.
+        The frame for beat stays the same, so the song position is kept.
+        """
+        _check_bpm(bpm)
+        beat = max(float(beat), 0.)
+        self.segments = [s for s in self.segments if s[0] < beat]
+        self.segments.append((beat, bpm))
+        self._rebuild()
+
+    def beat_to_frame(self, beat):
+        i = max(bisect_right(self._beats, beat) - 1, 0)
+        return (self._frames[i] +
+                (beat - self._beats[i]) * self.frames_per_beat(self._bpms[i]))
+
+    def frame_to_beat(self, frame):
+        i = max(bisect_right(self._frames, frame) - 1, 0)
+        return (self._beats[i] + (frame - self._frames[i]) /
+                self.frames_per_beat(self._bpms[i]))
+
+    def beat_to_seconds(self, beat):
+        return self.beat_to_frame(beat) / self.samplerate
+
+    def dump(self):
+        return [[beat, bpm] for beat, bpm in self.segments]
+
+    def load(self, data):
+        segments = sorted((float(beat), bpm) for beat, bpm in data)
+        if segments[0][0] > 0:
+            segments.insert(0, (0., segments[0][1]))
+        self.segments = segments
+        self._rebuild()
+
+
+def _check_bpm(bpm):
+    if not bpm > 0:
+        raise ValueError('Tempo must be above 0 bpm, got {}'.format(bpm))
@@ -4,11 +4,13 @@ Track Modules.
 Has the base Track class from which all other track types derive.
 """
 
-from copy import deepcopy
-from bisect import bisect_left
+from array import array
+from bisect import bisect_left, insort
+from itertools import chain
+from math import floor
 
-from connections import seq
-from util import ntime
+import connections
+from util import ntime, next_version, Snapshot, thaw
 
 from sequencer_interface import (
     MIDI_EVENT_NOTE_ON as NOTE_ON,
@@ -35,6 +37,19 @@ times = {
 }
 
 
+def play_event(port, event, channel, note, velocity, offset=None):
+    """
+    Send a single (event, channel, note, velocity) sequence entry to the
+    sequencer
+    """
+    if event == NOTE_ON:
+        connections.seq.note_on(port, note, channel, velocity, offset)
+    elif event == NOTE_OFF:
+        connections.seq.note_off(port, note, channel, offset)
+    elif event == PITCH:
+        connections.seq.set_pitchbend(port, velocity, channel, offset)
+
+
 # Dummy track definition to inherit from
 class Track(object):
     # Track type. Each class has to have it's own
@@ -43,6 +58,12 @@ class Track(object):
     name = ''
     # Midi Port (Name of the synth to send events to)
     midi_port = 'Undefined'
+    # Change counter, see touch()
+    version = 0
+    # (version and header, snapshot) of the last snapshot taken
+    _snapshot = None
+    # Compiled sequence, see data_seq
+    _data_seq = None
 
     def len(self):
         """
@@ -121,12 +142,22 @@ class Track(object):
         """
         pass
 
-    def play_range(self, prev_time, curr_time):
+    def play_range(self, prev_time, curr_time, offset=0):
         """
-        Play all events between prev_time <= event_time <= curr_time
+        Play all events between prev_time <= event_time <= curr_time.
+
+        Each event is sent along with its distance in beats from the start of
+        the play window plus offset, so the sequencer can timestamp it.
         """
         pass
 
+    def sequence(self):
+        """
+        Return the sorted (time, event, channel, note, velocity) list of the
+        events played in one loop of the track
+        """
+        return []
+
     def shift(self, time):
         """
         Shift all notes by a positive or negative number of beats
@@ -139,27 +170,95 @@ class Track(object):
         """
         pass
 
+    @property
+    def data_seq(self):
+        """
+        Sequence compiled from the track data by rebuild_sequence(), built
+        the first time it is used after a change. UI thread only, the player
+        reads what compile() left in _data_seq.
+        """
+        if self._data_seq is None:
+            self.rebuild_sequence()
+        return self._data_seq
+
+    def compile(self):
+        """
+        Build data_seq now if a change dropped it, called on the UI thread
+        before the player needs it
+        """
+        if self._data_seq is None:
+            self.rebuild_sequence()
+
+    def rebuild_sequence(self):
+        """
+        Compile data_seq from the track data
+        """
+        pass
+
+    def invalidate(self):
+        """
+        Mark the track as changed and drop the compiled sequence
+        """
+        self._data_seq = None
+        self.touch()
+
+    def touch(self):
+        """
+        Mark the track as changed. Versions are unique across tracks, so the
+        versions of a track list also tell when tracks were added, removed
+        or moved.
+        """
+        self.version = next_version()
+
+    def header(self):
+        """
+        Return the track settings other than the events
+        """
+        return (self.name, self.midi_port, self.midi_channel)
+
     def bind(self):
         """
         Set the real midi port number for the midi port name
         """
-        self._midi_port = seq.ports.get(self.midi_port)
+        self._midi_port = connections.get_port(self.midi_port)
 
-    def stop(self):
+    def stop(self, offset=None):
         """
-        Send a note_off for all events
+        Send a note_off for all events, offset beats into the play window when
+        given
+        """
+        pass
+
+    def copy(self):
         """
+        Return a new track with the same settings and events. Events are
+        shared with this track until either of them changes.
+        """
+        pass
+
+    def snapshot(self):
+        """
+        Return the data of dump() as a read only Snapshot. Taking one again
+        before the track changes returns the same object, events are shared
+        with the track instead of copied.
+        """
+        key = (self.version, self.header())
+        if self._snapshot is None or self._snapshot[0] != key:
+            self._snapshot = (key, self._take_snapshot())
+        return self._snapshot[1]
+
+    def _take_snapshot(self):
         pass
 
     def dump(self):
         """
         Return serialized data as dict
         """
-        pass
+        return thaw(self.snapshot())
 
     def load(self, data):
         """
-        Load from serialized data as dict
+        Load from serialized data as dict, or from a snapshot
         """
         pass
 
@@ -178,10 +277,11 @@ class DrumTrack(Track):
                  midi_port='', midi_channel=0, note=0):
         self.name = name
         self.midi_port = midi_port
-        self._midi_port = seq.ports.get(midi_port)
+        self._midi_port = connections.get_port(midi_port)
         self.midi_channel = int(midi_channel)
         self.note = note
         self.data = data
+        self.invalidate()
 
     def len(self):
         return len(self.data)
@@ -192,6 +292,7 @@ class DrumTrack(Track):
         for i in xrange(lenght):
             tmp_data[i] = self.data[i % old_len]
         self.data = tmp_data
+        self.invalidate()
 
     def note_on(self, time, channel, note, velocity):
         self.seq_note_on(channel, note, velocity)
@@ -203,30 +304,54 @@ class DrumTrack(Track):
         if note in note_pos:
             time = note_pos.index(note) % self.len()
             self.data[time] = nextval[self.data[time]]
+            self.invalidate()
 
     def seq_note_on(self, channel, note, velocity):
         if self._midi_port is None:
-            seq.note_on(self._midi_port, self.note, self.midi_channel, 127)
+            connections.seq.note_on(self._midi_port, self.note,
+                                    self.midi_channel, 127)
 
     def quantize(self, time, value):
         if value != "0" and self.data[int(time)] != ' ':
             self.data[int(time)] = value
+            self.invalidate()
 
     def clear(self, time):
         self.data[int(time)] = ' '
+        self.invalidate()
 
     def shift(self, time):
         time = int(time)
         self.data = self.data[time:] + self.data[:time]
+        self.invalidate()
 
-    def dump(self):
-        return deepcopy({
+    def header(self):
+        return (self.name, self.midi_port, self.midi_channel, self.note)
+
+    def rebuild_sequence(self):
+        # Sorted hit times, all hits are the same note on
+        self._data_seq = array('d', [
+            pos + time
+            for pos, value in enumerate(self.data or [])
+            for time in times[value]
+        ])
+
+    def sequence(self):
+        return [(time, NOTE_ON, self.midi_channel, self.note, 127)
+                for time in self.data_seq]
+
+    def copy(self):
+        return DrumTrack(self.name, list(self.data), self.midi_port,
+                         self.midi_channel, self.note)
+
+    def _take_snapshot(self):
+        return Snapshot({
             "track_type": self.track_type,
             "name": self.name,
             "midi_port": self.midi_port,
             "midi_channel": self.midi_channel,
             "note": self.note,
-            "data": self.data,
+            "data": tuple(self.data),
         })
 
     def load(self, data):
@@ -234,30 +359,148 @@ class DrumTrack(Track):
         self.midi_port = data['midi_port']
         self.midi_channel = int(data['midi_channel'])
         self.note = data['note']
-        self.data = data['data']
-
-    def play_range(self, prev_time, curr_time):
-        # Check the data for track y and see if there is an event between
-        # prev_time and curr_time
-        if self._midi_port is None:
+        self.data = list(data['data'])
+        self.bind()
+        self.invalidate()
+
+    def play_range(self, prev_time, curr_time, offset=0):
+        # Never compiled here, see compile()
+        data_seq = self._data_seq
+        if self._midi_port is None or not data_seq:
             return
 
-        pos = int(curr_time)
-        note = self.data[pos % len(self.data)]
-        for time in times[note]:
-            time += pos
-            if prev_time <= curr_time:
-                play_note = prev_time <= time < curr_time
-            else:
-                play_note = prev_time <= time or time < curr_time
-
-            if play_note:
-                seq.note_on(self._midi_port, self.note, self.midi_channel, 127)
+        track_len = self.len()
+        if curr_time < prev_time:
+            # Window wraps around the end of the track
+            curr_time += track_len
+
+        # Walk the hits from prev_time on, looping over the track as many
+        # times as the window needs
+        loop_start = floor(prev_time / track_len) * track_len
+        i = bisect_left(data_seq, prev_time - loop_start)
+        seq_len = len(data_seq)
+        while True:
+            if i == seq_len:
+                i = 0
+                loop_start += track_len
+            time = loop_start + data_seq[i]
+            if time >= curr_time:
+                break
+            connections.seq.note_on(self._midi_port, self.note,
+                                    self.midi_channel, 127,
+                                    offset + time - prev_time)
+            i += 1
 
     def __str__(self):
         return ''.join(self.data)
 
 
+class EventStore(object):
+    """
+    MidiTrack events stored as parallel array columns.
+
+    Row i is the event (time_on, time_off, channel, note, velocity, type).
+    A missing time_off (note still held) or note (pitchbend) is stored as -1
+    and read back as None.
+
+    Stores made by share() use the same columns until one of them changes,
+    then the changing store copies them first, unless no other store uses
+    them anymore.
+    """
+    COLUMNS = ('time_on', 'time_off', 'channel', 'note', 'velocity', 'type')
+    __slots__ = COLUMNS + ('_shared',)
+
+    def __init__(self, items=()):
+        self.time_on = array('d')
+        self.time_off = array('d')
+        self.channel = array('H')
+        self.note = array('h')
+        self.velocity = array('i')
+        self.type = array('B')
+        # One element list counting the stores using these columns, shared
+        # by them, or None when only this one does
+        self._shared = None
+        for item in items:
+            self.append(*item)
+
+    def share(self):
+        """
+        Return a store with the same events, sharing the columns
+        """
+        store = EventStore()
+        for column in self.COLUMNS:
+            setattr(store, column, getattr(self, column))
+        if self._shared is None:
+            self._shared = [1]
+        self._shared[0] += 1
+        store._shared = self._shared
+        return store
+
+    def _own(self):
+        shared = self._shared
+        if shared is None:
+            return
+        shared[0] -= 1
+        if shared[0]:
+            for column in self.COLUMNS:
+                values = getattr(self, column)
+                setattr(self, column, array(values.typecode, values))
+        self._shared = None
+
+    def __len__(self):
+        return len(self.time_on)
+
+    def __eq__(self, other):
+        return isinstance(other, EventStore) and all(
+            getattr(self, column) == getattr(other, column)
+            for column in self.COLUMNS
+        )
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __getitem__(self, i):
+        time_off = self.time_off[i]
+        note = self.note[i]
+        return (
+            self.time_on[i],
+            None if time_off < 0 else time_off,
+            self.channel[i],
+            None if note < 0 else note,
+            self.velocity[i],
+            self.type[i],
+        )
+
+    def __iter__(self):
+        for i in xrange(len(self.time_on)):
+            yield self[i]
+
+    def append(self, time_on, time_off, channel, note, velocity, ev_type):
+        """
+        Add an event and return its row
+        """
+        self._own()
+        self.time_on.append(time_on)
+        self.time_off.append(-1 if time_off is None else time_off)
+        self.channel.append(channel)
+        self.note.append(-1 if note is None else note)
+        self.velocity.append(velocity)
+        self.type.append(ev_type)
+        return len(self.time_on) - 1
+
+    def set_time_off(self, i, time_off):
+        self._own()
+        self.time_off[i] = -1 if time_off is None else time_off
+
+    def remove(self, i):
+        self._own()
+        for column in self.COLUMNS:
+            del getattr(self, column)[i]
+
+    def dump(self):
+        return [list(item) for item in self]
+
+
 class MidiTrack(Track):
     track_type = TRACK_TYPE_BASSLINE
 
@@ -265,14 +508,13 @@ class MidiTrack(Track):
                  midi_port='', midi_channel=0):
         self.name = name
         self._len = lenght
-        self.data = data
+        self.data = EventStore(data or ())
         self.qmap = qmap
         self.midi_port = midi_port
-        self._midi_port = seq.ports.get(midi_port)
+        self._midi_port = connections.get_port(midi_port)
         self._midi_channel = int(midi_channel)
         self._state = {}
-        if data is not None:
-            self.rebuild_sequence()
+        self.touch()
 
     @property
     def midi_channel(self):
@@ -284,7 +526,16 @@ class MidiTrack(Track):
         if channel != self._midi_channel:
             self.stop()
             self._midi_channel = channel
+            self.invalidate()
+
+    @property
+    def beat_data(self):
+        """
+        One character per beat for display, compiled along with data_seq
+        """
+        if self._data_seq is None:
             self.rebuild_sequence()
+        return self._beat_data
 
     def len(self):
         return self._len
@@ -312,29 +563,52 @@ class MidiTrack(Track):
                     notes_added = True
             i += 1
 
-        self.data = tmp_data
+        self.data = EventStore(tmp_data)
         self.qmap = tmp_qmap
         self._len = lenght
-        self.rebuild_sequence()
-
-    def dump(self):
-        return deepcopy({
+        self._state = {}
+        self.invalidate()
+
+    def copy(self):
+        track = MidiTrack(self.name, self._len, None, list(self.qmap),
+                          self.midi_port, self._midi_channel)
+        track.data = self.data.share()
+        if self._data_seq is not None:
+            # The compiled sequence is the same, copy it instead of
+            # rebuilding
+            track._data_seq = list(self._data_seq)
+            track._beat_data = list(self._beat_data)
+            track._beat_notes = list(self._beat_notes)
+            track._beat_pitches = list(self._beat_pitches)
+        return track
+
+    def _take_snapshot(self):
+        return Snapshot({
             "track_type": self.track_type,
             'name': self.name,
             'len': self.len(),
             'midi_port': self.midi_port,
             'midi_channel': self.midi_channel,
-            'data': self.data,
-            'qmap': self.qmap
+            'data': self.data.share(),
+            'qmap': tuple(self.qmap),
         })
 
     def load(self, data):
+        # Release the notes of the data being replaced, a track without a
+        # compiled sequence has nothing sounding
+        self.stop()
         self.name = data['name']
         self._len = data['len']
         self.midi_channel = int(data.get('midi_channel', 0))
         self.midi_port = data.get('midi_port', 'Undefined')
-        self.data = []
-        for item in data['data']:
+        if isinstance(data['data'], EventStore):
+            # From a snapshot or a binary project file
+            self.data = data['data'].share()
+            items = ()
+        else:
+            self.data = EventStore()
+            items = data['data']
+        for item in items:
             # Add track to old tracks
             if len(item) == 4:
                 time_on, time_off, note, velocity = item
@@ -343,18 +617,19 @@ class MidiTrack(Track):
                 time_on, time_off, channel, note, velocity = item
                 item = (time_on, time_off, channel, note, velocity, NOTE_ON)
 
-            self.data.append(item)
+            self.data.append(*item)
 
-        self.qmap = data['qmap']
-        self.rebuild_sequence()
-        self.stop()
+        self.qmap = list(data['qmap'])
+        self._state = {}
+        self.bind()
+        self.invalidate()
 
     def note_on(self, time, channel, note, velocity):
         self.seq_note_on(channel, note, velocity)
         time_on = ntime(time % self.len())
-        self.data.append([time_on, None, channel, note, velocity, NOTE_ON])
-        self._state[note] = time_on
-        self.rebuild_sequence()
+        i = self.data.append(time_on, None, channel, note, velocity, NOTE_ON)
+        self._state[note] = i
+        self._add_item(self.data[i])
 
     def seq_note_on(self, channel, note, velocity):
         if self._midi_port is None:
@@ -363,7 +638,7 @@ class MidiTrack(Track):
         if self.midi_channel != CHANNEL_ALL:
             channel = self.midi_channel
 
-        seq.note_on(self._midi_port, note, channel, velocity)
+        connections.seq.note_on(self._midi_port, note, channel, velocity)
 
     def note_off(self, time, channel, note):
         self.seq_note_off(channel, note)
@@ -371,16 +646,10 @@ class MidiTrack(Track):
             return
 
         time_off = ntime(time % self.len())
-        time_on = self._state[note]
-        item = None
-        for item in self.data:
-            if time_on == item[0] and note == item[3] and channel == item[2]:
-                break
-        if item:
-            item[1] = time_off
-
-        del self._state[note]
-        self.rebuild_sequence()
+        i = self._state.pop(note)
+        self._remove_item(self.data[i])
+        self.data.set_time_off(i, time_off)
+        self._add_item(self.data[i])
 
     def seq_note_off(self, channel, note):
         if self._midi_port is None:
@@ -389,13 +658,13 @@ class MidiTrack(Track):
         if self.midi_channel != CHANNEL_ALL:
             channel = self.midi_channel
 
-        seq.note_off(self._midi_port, note, channel)
+        connections.seq.note_off(self._midi_port, note, channel)
 
     def pitchbend(self, time, value, channel):
         self.seq_pitchbend(value, channel)
         time_on = ntime(time % self.len())
-        self.data.append([time_on, None, channel, None, value, PITCH])
-        self.rebuild_sequence()
+        i = self.data.append(time_on, None, channel, None, value, PITCH)
+        self._add_item(self.data[i])
 
     def seq_pitchbend(self, value, channel):
         if self._midi_port is None:
@@ -404,31 +673,50 @@ class MidiTrack(Track):
         if self.midi_channel != CHANNEL_ALL:
             channel = self.midi_channel
 
-        seq.set_pitchbend(self._midi_port, value, channel)
+        connections.seq.set_pitchbend(self._midi_port, value, channel)
 
     def quantize(self, time, value):
-        self.qmap[int(time)] = int(value)
-        self.rebuild_sequence()
+        itime = int(time)
+        if self._data_seq is None:
+            self.qmap[itime] = int(value)
+            self.touch()
+            return
+
+        items = [self.data[i]
+                 for i, time_on in enumerate(self.data.time_on)
+                 if int(time_on) == itime]
+        for item in items:
+            self._remove_item(item)
+        self.qmap[itime] = int(value)
+        for item in items:
+            self._add_item(item)
+        self._update_beat(itime)
+        self.touch()
 
     def clear(self, time, event_type=None):
         mark_deletion = []
-        for item in self.data:
+        for i, item in enumerate(self.data):
             time_on, time_off, channel, note, velocity, ev_type = item
             if time <= time_on < time + 1:
                 if event_type is None or event_type == ev_type:
-                    mark_deletion.append(item)
+                    mark_deletion.append(i)
                 if ev_type in [NOTE_ON, NOTE_OFF]:
                     channel = channel & 255 or self.midi_channel
-                    seq.note_off(self._midi_port, note, channel)
-
-        for del_item in mark_deletion:
-            self.data.remove(del_item)
-        self.rebuild_sequence()
+                    connections.seq.note_off(self._midi_port, note, channel)
+
+        for i in reversed(mark_deletion):
+            self._remove_item(self.data[i])
+            self.data.remove(i)
+            # Rows after i moved one up
+            self._state = dict(
+                (note, j - (j > i)) for note, j in self._state.items()
+                if j != i
+            )
 
     def shift(self, time):
         time = int(time)
         clen = self.len()
-        self.data = [
+        self.data = EventStore(
             (
                 (time_on-time) % clen,
                 (time_off-time) % clen,
@@ -440,90 +728,133 @@ class MidiTrack(Track):
             for time_on, time_off, channel, note, velocity, ev_type
             in self.data
             if time_on is not None and time_off is not None
-        ]
+        )
         self.qmap = self.qmap[time:] + self.qmap[:time]
-        self.rebuild_sequence()
+        self._state = {}
+        self.invalidate()
 
     def rebuild_sequence(self):
-        self.data_seq = []
-        self.beat_data = [' '] * self._len
-        if not self.data:
-            return
-        for time_on, time_off, channel, note, velocity, ev_type in self.data:
-            if self.midi_channel != CHANNEL_ALL:
-                channel = self.midi_channel
+        """
+        Build data_seq and beat_data from scratch. Only needed when the
+        channel, the length or the whole data change; once compiled, single
+        events are indexed by _add_item and _remove_item.
+        """
+        data_seq = []
+        self._beat_data = [' '] * self._len
+        # Notes and pitchbends starting on each beat
+        self._beat_notes = [0] * self._len
+        self._beat_pitches = [0] * self._len
+        for item in self.data:
+            data_seq.extend(self._item_sequence(item))
+            self._count_item(item, 1)
 
-            if ev_type == NOTE_ON:
-                self._data_seq_add_note(time_on, time_off, channel, note,
-                                        velocity)
-            elif ev_type == PITCH:
-                self._data_seq_add_pitch(time_on, channel, velocity)
+        data_seq.sort()
+        for itime in xrange(self._len):
+            self._update_beat(itime)
+        self._data_seq = data_seq
 
-        self.data_seq.sort()
+    def _item_sequence(self, item):
+        """
+        Return the data_seq entries for a data item, quantized
+        """
+        time_on, time_off, channel, note, velocity, ev_type = item
+        if self.midi_channel != CHANNEL_ALL:
+            channel = self.midi_channel
 
-    def _data_seq_add_note(self, time_on, time_off, channel, note, velocity):
-            itime = int(time_on)
-            data_repr = '*'
-            qvalue = self.qmap[itime]
+        if ev_type == NOTE_ON:
+            qvalue = self.qmap[int(time_on)]
             qdelta = 0
             if qvalue:
-                data_repr = str(qvalue)
                 qdelta = time_on - round(time_on * qvalue) / qvalue
 
-            time_on = (time_on - qdelta) % self._len
-
-            if self.midi_channel != CHANNEL_ALL:
-                self.midi_channel
-
-            self.data_seq.append((time_on, NOTE_ON, channel, note, velocity))
-
+            sequence = [
+                ((time_on - qdelta) % self._len, NOTE_ON, channel, note,
+                 velocity)
+            ]
             if time_off:
                 time_off = (time_off - qdelta) % self._len
-                self.data_seq.append((time_off, NOTE_OFF, channel, note, 0))
-
-            self.beat_data[itime] = data_repr
-
-    def _data_seq_add_pitch(self, time_on, channel, value):
-            itime = int(time_on)
-            time_on = time_on % self._len
-
-            if self.midi_channel != CHANNEL_ALL:
-                self.midi_channel
-
-            self.data_seq.append((time_on, PITCH, channel, None, value))
-
-            if self.beat_data[itime] == ' ':
-                self.beat_data[itime] = '#'
+                sequence.append((time_off, NOTE_OFF, channel, note, 0))
+            return sequence
+        elif ev_type == PITCH:
+            return [(time_on % self._len, PITCH, channel, None, velocity)]
+        return []
+
+    def _count_item(self, item, count):
+        ev_type = item[5]
+        if ev_type == NOTE_ON:
+            self._beat_notes[int(item[0])] += count
+        elif ev_type == PITCH:
+            self._beat_pitches[int(item[0])] += count
+
+    def _update_beat(self, itime):
+        if self._beat_notes[itime]:
+            qvalue = self.qmap[itime]
+            self._beat_data[itime] = str(qvalue) if qvalue else '*'
+        elif self._beat_pitches[itime]:
+            self._beat_data[itime] = '#'
+        else:
+            self._beat_data[itime] = ' '
 
-    def play_range(self, prev_time, curr_time):
-        if self._midi_port is None:
+    def _add_item(self, item):
+        self.touch()
+        if self._data_seq is None:
+            # Not compiled, nothing to keep up to date
+            return
+        # The player reads data_seq while we edit, change a copy and swap it
+        # in with one assignment
+        data_seq = list(self._data_seq)
+        for entry in self._item_sequence(item):
+            insort(data_seq, entry)
+        self._data_seq = data_seq
+        self._count_item(item, 1)
+        self._update_beat(int(item[0]))
+
+    def _remove_item(self, item):
+        self.touch()
+        if self._data_seq is None:
+            return
+        data_seq = list(self._data_seq)
+        for entry in self._item_sequence(item):
+            i = bisect_left(data_seq, entry)
+            if i < len(data_seq) and data_seq[i] == entry:
+                del data_seq[i]
+        self._data_seq = data_seq
+        self._count_item(item, -1)
+        self._update_beat(int(item[0]))
+
+    def play_range(self, prev_time, curr_time, offset=0):
+        # Never compiled here, see compile()
+        data_seq = self._data_seq
+        if self._midi_port is None or data_seq is None:
             return
 
         prev_time = prev_time % self.len()
         curr_time = curr_time % self.len()
 
-        prev_i = bisect_left(self.data_seq, (prev_time, None))
-        curr_i = bisect_left(self.data_seq, (curr_time, None))
+        prev_i = bisect_left(data_seq, (prev_time, None))
+        curr_i = bisect_left(data_seq, (curr_time, None))
 
         if prev_i <= curr_i:
-            play_seq = self.data_seq[prev_i:curr_i]
+            play_seq = xrange(prev_i, curr_i)
         else:
-            play_seq = self.data_seq[prev_i:] + self.data_seq[:curr_i]
+            play_seq = chain(xrange(prev_i, len(data_seq)), xrange(curr_i))
 
-        for time, event, channel, note, velocity in play_seq:
-            if event == NOTE_ON:
-                seq.note_on(self._midi_port, note, channel, velocity)
-            elif event == NOTE_OFF:
-                seq.note_off(self._midi_port, note, channel)
-            elif event == PITCH:
-                self.seq_pitchbend(velocity, channel)
+        for i in play_seq:
+            time, event, channel, note, velocity = data_seq[i]
+            play_event(self._midi_port, event, channel, note, velocity,
+                       offset + (time - prev_time) % self._len)
 
-    def stop(self):
-        if self._midi_port is None:
+    def stop(self, offset=None):
+        data_seq = self._data_seq
+        if self._midi_port is None or data_seq is None:
             return
 
-        for time, event, channel, note, velocity in self.data_seq:
+        for time, event, channel, note, velocity in data_seq:
             if event == NOTE_OFF:
-                seq.note_off(self._midi_port, note, channel)
+                connections.seq.note_off(self._midi_port, note, channel,
+                                         offset)
 
             # TODO: Add controller and pitchbend
+
+    def sequence(self):
+        return self.data_seq
@@ -0,0 +1,167 @@
+"""
+Undo journal.
+
+Keeps the edit history of a Project or a Pattern as a list of steps, each one
+holding only the previous state of the parts that changed.
+"""
+
+from collections import deque
+
+from project import Project
+
+# Approximate memory limit for the history, in bytes
+DEFAULT_MAX_SIZE = 32 * 1024 * 1024
+
+# Estimated cost of a shell, a track and a track event in memory
+ENTRY_SIZE = 256
+EVENT_SIZE = 64
+
+UNDO_PROJECT = 0
+UNDO_PATTERN = 1
+UNDO_TRACK = 2
+
+
+class UndoJournal(object):
+    """
+    Structural diff undo history for a Project or a Pattern.
+
+    The journal remembers the state of every project, pattern and track as
+    seen on the last commit(). Shells (names, lengths, the pattern and track
+    lists) are cheap to compare; track events are only dumped again when the
+    track version changed, so a commit costs the size of the change plus a
+    walk over the tracks. The oldest steps are forgotten once the history
+    grows past max_size.
+    """
+    def __init__(self, root, max_size=DEFAULT_MAX_SIZE):
+        self.root = root
+        self.max_size = max_size
+        self.size = 0
+        self._steps = deque()
+        # id(obj) -> (kind, obj, state) as seen on the last commit
+        self._seen = {}
+        self._scan()
+
+    def __len__(self):
+        return len(self._steps)
+
+    def commit(self):
+        """
+        Record the changes since the last commit as an undo step. Return
+        False when nothing changed.
+        """
+        changes = self._scan()
+        if not changes:
+            return False
+
+        size = sum(_state_size(kind, state) for kind, obj, state in changes)
+        self._steps.append((changes, size))
+        self.size += size
+        while self.size > self.max_size and len(self._steps) > 1:
+            self.size -= self._steps.popleft()[1]
+        return True
+
+    def undo(self):
+        """
+        Go back to the state before the last step. Changes not committed yet
+        are committed first, so they are the ones undone.
+        """
+        self.commit()
+        if not self._steps:
+            return False
+
+        changes, size = self._steps.pop()
+        self.size -= size
+        for kind, obj, state in changes:
+            _restore(kind, obj, state)
+        if isinstance(self.root, Project):
+            self.root.rebuild_sequence()
+        # The restored states are the new reference, not a change
+        self._scan()
+        return True
+
+    def clear(self):
+        self._steps.clear()
+        self.size = 0
+        self._scan()
+
+    def _scan(self):
+        """
+        Walk the root, refresh the seen states and return the previous state
+        of everything that changed as [(kind, obj, state)]
+        """
+        changes = []
+        seen = {}
+        if isinstance(self.root, Project):
+            self._check(UNDO_PROJECT, self.root, changes, seen)
+            patterns = self.root.patterns
+        else:
+            patterns = [self.root]
+        for pattern in patterns:
+            self._check(UNDO_PATTERN, pattern, changes, seen)
+            if not pattern.loaded():
+                continue
+            for track in pattern.tracks or ():
+                self._check(UNDO_TRACK, track, changes, seen)
+        self._seen = seen
+        return changes
+
+    def _check(self, kind, obj, changes, seen):
+        prev = self._seen.get(id(obj))
+        if kind == UNDO_TRACK:
+            header = obj.header()
+            if (prev is not None and prev[2][0] == obj.version and
+                    prev[2][1] == header):
+                # Unchanged, keep the dump we already have
+                seen[id(obj)] = prev
+                return
+            state = (obj.version, header, obj.snapshot())
+        else:
+            state = _shell(kind, obj)
+
+        seen[id(obj)] = (kind, obj, state)
+        # Objects new to the journal come with a change in their parent
+        if prev is None:
+            return
+        if kind == UNDO_TRACK:
+            changed = prev[2][1:] != state[1:]
+        elif kind == UNDO_PATTERN and prev[2][3] is None:
+            # Loading the tracks of a lazy pattern is not a change
+            changed = prev[2][:3] != state[:3]
+        else:
+            changed = prev[2] != state
+        if changed:
+            changes.append(prev)
+
+
+def _shell(kind, obj):
+    if kind == UNDO_PROJECT:
+        return (obj.name, obj.tempo_map, tuple(obj.tempo_map.segments),
+                tuple(obj.patterns), tuple(obj.patterns_seq))
+    if not obj.loaded():
+        return (obj.name, obj.len, obj.uid, None)
+    return (obj.name, obj.len, obj.uid, tuple(obj.tracks or ()))
+
+
+def _restore(kind, obj, state):
+    if kind == UNDO_PROJECT:
+        name, tempo_map, segments, patterns, patterns_seq = state
+        obj.name = name
+        tempo_map.load(segments)
+        obj.tempo_map = tempo_map
+        obj.patterns = list(patterns)
+        obj.patterns_seq = list(patterns_seq)
+    elif kind == UNDO_PATTERN:
+        obj.name, obj.len, obj.uid, tracks = state
+        if tracks is not None:
+            obj.tracks = list(tracks)
+        obj.touch()
+    else:
+        obj.load(state[2])
+        obj.bind()
+
+
+def _state_size(kind, state):
+    if kind == UNDO_TRACK:
+        return ENTRY_SIZE + EVENT_SIZE * len(state[2].get('data') or ())
+    return ENTRY_SIZE + EVENT_SIZE * sum(
+        len(value) for value in state if isinstance(value, tuple))
@@ -1,4 +1,5 @@
 import uuid
+from itertools import count
 
 try:
     import prctl
@@ -23,5 +24,98 @@ def gen_uid():
     return str(uuid.uuid4())[:8]
 
 
+_versions = count(1)
+
+
+def next_version():
+    """
+    Return a change counter value that was never returned before, so
+    versions of different objects never collide
+    """
+    return next(_versions)
+
+
+class Snapshot(dict):
+    """
+    Read only dict, the immutable form of the data returned by dump()
+    methods. Lists are stored as tuples.
+    """
+    __slots__ = ()
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('Snapshots are read only')
+
+    __setitem__ = __delitem__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+
+def thaw(value):
+    """
+    Return plain dump() data, new dicts and lists, for a snapshot. Objects
+    with a dump() method, like EventStore, are dumped.
+    """
+    if isinstance(value, dict):
+        return dict((key, thaw(item)) for key, item in value.iteritems())
+    elif hasattr(value, 'dump'):
+        return value.dump()
+    elif isinstance(value, (list, tuple)):
+        return [thaw(item) for item in value]
+    return value
+
+
 def ntime(time):
     return int(time * 1000000) / 1000000.
+
+
+class Histogram(object):
+    """
+    Fixed size histogram of values between low and high split in equal
+    buckets. Values out of range are counted in the first or last bucket.
+    """
+    def __init__(self, low, high, buckets=200):
+        self.low = low
+        self.high = high
+        self.width = float(high - low) / buckets
+        self.counts = [0] * buckets
+        self.clear()
+
+    def clear(self):
+        self.counts = [0] * len(self.counts)
+        self.count = 0
+        self.total = 0.
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        i = int((value - self.low) / self.width)
+        self.counts[min(max(i, 0), len(self.counts) - 1)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """
+        Return the upper edge of the bucket holding the given percentile
+        """
+        if not self.count:
+            return None
+        limit = self.count * percent / 100.
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= limit:
+                break
+        return self.low + (i + 1) * self.width
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+        }